@@ -1,29 +1,55 @@
 # medical_agent_project/plugin/analyzer.py
 
 import base64
+import os
+import tempfile
+import threading
+from contextlib import nullcontext
 from PIL import Image
 from io import BytesIO
 import traceback
 from .utils.segmentation import SegmentationModel
-from .utils.postprocessing import convert_label_to_color_mask
-from .utils.measurement import measure_from_color_mask
+from .utils import timing
+from .utils.measurement import (measure_from_label_mask, measure_label_stream, summarize_cine_loop,
+                                CHANGE_THRESHOLD)
 
-seg_model = SegmentationModel()
+_seg_model = None
+_seg_model_lock = threading.Lock()
 
-def analyze_3vv_image(image_base64_string: str) -> dict:
-    try:
-        # 1. 解码原始图像
-        image_data = base64.b64decode(image_base64_string)
-        image_pil = Image.open(BytesIO(image_data)).convert('RGB')
+def get_seg_model() -> SegmentationModel:
+    # 首次请求时才创建分割模型，导入本模块不再触发模型初始化
+    global _seg_model
+    if _seg_model is None:
+        with _seg_model_lock:
+            if _seg_model is None:
+                _seg_model = SegmentationModel()
+    return _seg_model
+
+def analyze_3vv_image(image_base64_string: str, debug: bool = False) -> dict:
+    """
+    debug=True 时在返回结果中附带本次请求各阶段的耗时 "timings"：{阶段: {'calls', 'wall', 'cpu'}}（秒）。
+    """
+    with (timing.record() if debug else nullcontext()) as timings:
+        result = _analyze_3vv_image(image_base64_string)
+    if debug:
+        result["timings"] = timings
+    return result
 
-        # 2. 调用分割模块，得到【数字标签掩码】
-        label_mask_np = seg_model.predict(image_pil)
+def _analyze_3vv_image(image_base64_string: str) -> dict:
+    try:
+        with timing.stage("total"):
+            # 1. 解码原始图像
+            with timing.stage("decode"):
+                image_data = base64.b64decode(image_base64_string)
+                image_pil = Image.open(BytesIO(image_data)).convert('RGB')
 
-        # 3. 调用后处理模块，将数字标签掩码转换为【彩色掩码】
-        color_mask_pil = convert_label_to_color_mask(label_mask_np)
+            # 2. 调用分割模块，得到【数字标签掩码】
+            with timing.stage("segment"):
+                label_mask_np = get_seg_model().predict(image_pil)
 
-        # 4. 调用测量模块，传入【彩色掩码】并得到最终结果
-        diameters = measure_from_color_mask(color_mask_pil)
+            # 3. 调用测量模块，直接传入【数字标签掩码】并得到最终结果
+            with timing.stage("measure"):
+                diameters = measure_from_label_mask(label_mask_np)
         
         if diameters is None:
              return {"status": "error", "message": "Measurement failed."}
@@ -32,4 +58,53 @@ def analyze_3vv_image(image_base64_string: str) -> dict:
 
     except Exception as e:
         print(f"在analyzer.py中处理图像时出错: {e}")
-        return {"status": "error", "message": str(e), "details": traceback.format_exc()}
\ No newline at end of file
+        return {"status": "error", "message": str(e), "details": traceback.format_exc()}
+
+def _iter_frames(source):
+    # 视频文件路径用 OpenCV 逐帧读取；否则视为 PIL Image / RGB numpy 数组组成的序列
+    if isinstance(source, str):
+        import cv2
+        capture = cv2.VideoCapture(source)
+        if not capture.isOpened():
+            raise IOError(f"无法打开视频文件: {source}")
+        try:
+            while True:
+                ok, frame_bgr = capture.read()
+                if not ok:
+                    break
+                yield Image.fromarray(cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB))
+        finally:
+            capture.release()
+    else:
+        for frame in source:
+            yield frame if isinstance(frame, Image.Image) else Image.fromarray(frame)
+
+def iter_3vv_video(source, change_threshold=CHANGE_THRESHOLD):
+    """
+    流式分析 3VV cine loop：source 为视频文件路径或帧序列，逐帧生成 AO/DA 直径。
+    相邻帧之间复用 ROI 与中心线（见 CineLoopTracker），只在掩码明显变化时重新骨架化。
+    """
+    seg_model = get_seg_model()
+    label_masks = (seg_model.predict(frame.convert('RGB')) for frame in _iter_frames(source))
+    return measure_label_stream(label_masks, change_threshold)
+
+def analyze_3vv_video(video_base64_string: str, suffix: str = ".mp4") -> dict:
+    video_path = None
+    try:
+        # OpenCV 只能从文件读取视频，先写入临时文件
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+            f.write(base64.b64decode(video_base64_string))
+            video_path = f.name
+
+        frames = list(iter_3vv_video(video_path))
+        if not frames:
+            return {"status": "error", "message": "Video contains no frames."}
+
+        return {"status": "success", "data": {"frames": frames, "summary": summarize_cine_loop(frames)}}
+
+    except Exception as e:
+        print(f"在analyzer.py中处理视频时出错: {e}")
+        return {"status": "error", "message": str(e), "details": traceback.format_exc()}
+    finally:
+        if video_path and os.path.exists(video_path):
+            os.remove(video_path)
@@ -1,9 +1,11 @@
 # medical_agent_project/plugin/app.py
 
+import os
 from flask import Flask, request, jsonify
 # --- 主要变化在这里 ---
 # 我们在 analyzer 前面加了一个点(.)，表示从当前包导入
-from .analyzer import analyze_3vv_image 
+from .analyzer import analyze_3vv_image, analyze_3vv_video, get_seg_model
+from .utils import timing
 # --- 变化结束 ---
 
 # 创建一个Flask应用实例
@@ -24,12 +26,39 @@ def handle_analyze_request():
 
     image_base64 = data['image']
 
-    # 调用我们的核心分析函数
-    result = analyze_3vv_image(image_base64)
+    # 调用我们的核心分析函数；"debug": true 时响应中附带各阶段耗时
+    result = analyze_3vv_image(image_base64, debug=bool(data.get('debug')))
 
     # 将函数的结果作为JSON响应返回
     return jsonify(result)
 
+@app.route('/analyze_3vv_video', methods=['POST'])
+def handle_analyze_video_request():
+    """
+    分析一段 3VV cine loop 视频，返回逐帧直径以及整段视频的汇总（如最大直径所在帧）。
+    """
+    if not request.is_json:
+        return jsonify({"status": "error", "message": "请求必须为JSON格式"}), 400
+
+    data = request.get_json()
+
+    if 'video' not in data:
+        return jsonify({"status": "error", "message": "JSON中缺少'video'字段"}), 400
+
+    result = analyze_3vv_video(data['video'], suffix=data.get('suffix', '.mp4'))
+    return jsonify(result)
+
+@app.route('/timings', methods=['GET'])
+def handle_timings_request():
+    """
+    返回本进程内各阶段的累计耗时（秒）。统计来自 debug 请求，或设置 VESSELSEG_TIMING=1 后的所有请求。
+    """
+    return jsonify({"status": "success", "data": timing.totals()})
+
 if __name__ == '__main__':
+    # 启动时加载分割模型，第一次请求不必再等待模型初始化；
+    # debug 模式下重载器的父进程只负责监视文件，只在实际提供服务的子进程中加载
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        get_seg_model()
     # 启动这个Web服务器，监听本地的5000端口
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -3,80 +3,348 @@
 import cv2
 import numpy as np
 from skimage.morphology import skeletonize
-from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree
 from PIL import Image
+from . import timing
+
+# 骨架化前裁剪每个结构的包围盒时，四周额外保留的像素数
+ROI_MARGIN = 2
+# 计算切线时沿中心线前后各取的点数
+TANGENT_WINDOW = 3
+# cine loop 中相邻帧掩码变化像素比例不超过该值时，复用上一帧的中心线
+CHANGE_THRESHOLD = 0.02
+
+# AO, DA, TRA 的类别编号，与 postprocessing.CLASS_TO_COLOR 的定义一致
+_CLASS_IDS = np.array([1, 2, 3], dtype=np.uint8)
 
 # --- 您提供的所有辅助函数 ---
 def get_mask_from_rgb(img_rgb, color):
     return np.all(img_rgb == color, axis=-1)
 
-def get_centerline(mask):
-    skeleton = skeletonize(mask > 0)
-    return np.column_stack(np.nonzero(skeleton))
+def mask_bbox(mask, margin=0):
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    y0 = max(rows[0] - margin, 0)
+    x0 = max(cols[0] - margin, 0)
+    y1 = min(rows[-1] + margin + 1, mask.shape[0])
+    x1 = min(cols[-1] + margin + 1, mask.shape[1])
+    return y0, y1, x0, x1
+
+def get_centerline(mask, margin=ROI_MARGIN, bbox=None):
+    if bbox is None:
+        bbox = mask_bbox(mask, margin)
+    if bbox is None:
+        return np.empty((0, 2), dtype=np.intp)
+    y0, y1, x0, x1 = bbox
+    skeleton = skeletonize(mask[y0:y1, x0:x1] > 0)
+    return np.column_stack(np.nonzero(skeleton)) + (y0, x0)
 
 def closest_point(centerline, ref_point):
-    dists = cdist(centerline, ref_point[None])
-    idx = np.argmin(dists)
+    if isinstance(centerline, Centerline):
+        return centerline.nearest(ref_point)
+    _, idx = cKDTree(centerline).query(ref_point)
     return centerline[idx], idx
 
-def compute_normal(centerline, idx):
-    if len(centerline) < 2: return np.array([1, 0])
-    if idx == 0: p1, p2 = centerline[idx], centerline[idx + 1]
-    elif idx == len(centerline) - 1: p1, p2 = centerline[idx - 1], centerline[idx]
-    else: p1, p2 = centerline[idx - 1], centerline[idx + 1]
-    tangent = p2 - p1
-    normal = np.array([-tangent[1], tangent[0]])
-    norm = np.linalg.norm(normal)
-    return normal / norm if norm != 0 else np.array([1, 0])
-
-def measure_diameter(mask, point, normal_dir, length=100): # Increased length for safety
-    y0, x0 = point.astype(int)
-    coords = []
-    for d in range(-length, length):
-        x = int(x0 + d * normal_dir[1])
-        y = int(y0 + d * normal_dir[0])
-        if 0 <= y < mask.shape[0] and 0 <= x < mask.shape[1] and mask[y, x]:
-            coords.append((x, y))
-    if len(coords) >= 2:
-        p1, p2 = coords[0], coords[-1]
-        return np.linalg.norm(np.array(p1) - np.array(p2)), p1, p2
-    return 0, None, None
+# 先列出 4 邻域偏移，行走时优先经过阶梯拐角处的像素，而不是斜着跳过
+_NEIGHBOR_OFFSETS = np.array([(-1, 0), (0, -1), (0, 1), (1, 0), (-1, -1), (-1, 1), (1, -1), (1, 1)])
 
-# --- 主入口函数 ---
-def measure_from_color_mask(color_mask_pil: Image.Image):
+def order_skeleton(points):
     """
-    接收一张彩色的PIL Image掩码，执行测量并返回结果。
+    将骨架像素按 8 邻域连通关系排序为若干条路径。
+    返回排序后的点以及每条路径的起始下标；从端点开始行走，因此分叉的每一支各自成为一条路径。
     """
-    img_rgb = np.array(color_mask_pil.convert("RGB"))
+    n = len(points)
+    if n == 0:
+        return points, np.zeros(0, dtype=np.intp)
+    origin = points.min(axis=0) - 1
+    local = points - origin
+    grid = np.full(tuple(local.max(axis=0) + 2), -1, dtype=np.intp)
+    grid[local[:, 0], local[:, 1]] = np.arange(n)
+    neighbors = grid[local[:, None, 0] + _NEIGHBOR_OFFSETS[:, 0], local[:, None, 1] + _NEIGHBOR_OFFSETS[:, 1]]
+    degree = (neighbors >= 0).sum(axis=1)
 
-    mask_ao = get_mask_from_rgb(img_rgb, [255, 0, 0])
-    mask_da = get_mask_from_rgb(img_rgb, [0, 255, 0])
-    mask_tra = get_mask_from_rgb(img_rgb, [0, 0, 255])
+    neighbors = neighbors.tolist()
+    visited = [False] * n
+    order = []
+    starts = []
+    # 先从端点和孤立像素出发，剩下未访问的像素位于闭合环上
+    for seed in np.concatenate([np.flatnonzero(degree <= 1), np.arange(n)]).tolist():
+        if visited[seed]:
+            continue
+        starts.append(len(order))
+        current = seed
+        while current >= 0:
+            visited[current] = True
+            order.append(current)
+            current = next((j for j in neighbors[current] if j >= 0 and not visited[j]), -1)
+    return points[order], np.array(starts, dtype=np.intp)
+
+class Centerline:
+    """
+    按连通路径排好序的血管中心线，并预先计算每个点的切线与法线。
+    切线取沿路径前后各 window 个点的中心差分，因此 normals[idx] 是 O(1) 查表，且沿血管走向而非光栅顺序。
+    """
+
+    def __init__(self, points, window=TANGENT_WINDOW):
+        self.points, self.path_starts = order_skeleton(np.asarray(points))
+        self.tangents, self.normals = self._tangent_field(window)
+        self._tree = None
+
+    @classmethod
+    def from_mask(cls, mask, margin=ROI_MARGIN, window=TANGENT_WINDOW):
+        return cls(get_centerline(mask, margin), window)
+
+    def __len__(self):
+        return len(self.points)
+
+    def normal(self, idx):
+        return self.normals[idx]
+
+    @property
+    def tree(self):
+        # 首次查询时构建，之后该中心线上的所有查询共用
+        if self._tree is None:
+            self._tree = cKDTree(self.points)
+        return self._tree
+
+    def nearest(self, ref_points, k=1):
+        """
+        查询距离参考点最近的 k 个中心线点；ref_points 可以是单个 (y, x) 点，也可以是 (M, 2) 的一批点。
+        返回 (点坐标, 下标)，k > 1 时多出最后一维。
+        """
+        _, idx = self.tree.query(ref_points, k=k)
+        return self.points[idx], idx
+
+    def _tangent_field(self, window):
+        n = len(self.points)
+        if n == 0:
+            return np.zeros((0, 2)), np.zeros((0, 2))
+        lengths = np.diff(np.append(self.path_starts, n))
+        first = np.repeat(self.path_starts, lengths)
+        last = first + np.repeat(lengths, lengths) - 1
+        pos = np.arange(n)
+        lo = np.maximum(pos - window, first)
+        hi = np.minimum(pos + window, last)
+        tangents = (self.points[hi] - self.points[lo]).astype(float)
+        normals = np.column_stack([-tangents[:, 1], tangents[:, 0]])
+        norms = np.hypot(normals[:, 0], normals[:, 1])
+        degenerate = norms == 0
+        normals[degenerate] = (1, 0)
+        norms[degenerate] = 1
+        return tangents, normals / norms[:, None]
+
+def _sample_mask(mask, frames, ys, xs):
+    # 整数坐标采样；超出图像范围的采样点视为背景
+    h, w = mask.shape[-2:]
+    inside = (ys >= 0) & (ys < h) & (xs >= 0) & (xs < w)
+    hits = np.zeros(ys.shape, dtype=bool)
+    if frames is None:
+        hits[inside] = mask[ys[inside], xs[inside]]
+    else:
+        hits[inside] = mask[np.broadcast_to(frames[:, None], ys.shape)[inside], ys[inside], xs[inside]]
+    return hits
+
+def _sample_bilinear(mask, frames, ys, xs):
+    y0 = np.floor(ys).astype(int)
+    x0 = np.floor(xs).astype(int)
+    fy = ys - y0
+    fx = xs - x0
+    values = np.zeros(ys.shape)
+    for dy, wy in ((0, 1 - fy), (1, fy)):
+        for dx, wx in ((0, 1 - fx), (1, fx)):
+            values += wy * wx * _sample_mask(mask, frames, y0 + dy, x0 + dx)
+    return values
+
+def cast_rays(mask, points, normal_dirs, length=100, subpixel=False, step=0.25, frames=None):
+    """
+    一次性沿多条射线（每个 point/normal 一条）在掩码上采样。
+    points 与 normal_dirs 均为 (y, x) 行，可相互广播（一个点配多个方向，或多个点配一个方向）。
+    返回 (diameters, p1, p2)，端点为 (x, y)；命中不足两个采样点的射线端点为 NaN。
+    若给出 frames（每条射线对应的帧下标），mask 为 (N, H, W) 掩码栈，可一次处理多帧的射线。
+    """
+    points = np.atleast_2d(np.asarray(points, dtype=float))
+    normal_dirs = np.atleast_2d(np.asarray(normal_dirs, dtype=float))
+    points, normal_dirs = np.broadcast_arrays(points, normal_dirs)
+    n_rays = len(points)
+    if subpixel:
+        d = np.arange(-length, length, step, dtype=float)
+        origin = points
+    else:
+        d = np.arange(-length, length)
+        origin = np.trunc(points)
+    ys = origin[:, 0:1] + d[None] * normal_dirs[:, 0:1]
+    xs = origin[:, 1:2] + d[None] * normal_dirs[:, 1:2]
+
+    if frames is not None:
+        frames = np.asarray(frames, dtype=np.intp)
+    if subpixel:
+        values = _sample_bilinear(mask, frames, ys, xs)
+        hits = values >= 0.5
+    else:
+        ys = np.trunc(ys).astype(int)
+        xs = np.trunc(xs).astype(int)
+        hits = _sample_mask(mask, frames, ys, xs)
+
+    found = hits.sum(axis=1) >= 2
+    first = np.argmax(hits, axis=1)
+    last = hits.shape[1] - 1 - np.argmax(hits[:, ::-1], axis=1)
+    rows = np.arange(n_rays)
+
+    if subpixel:
+        # 在最后一个外部采样点与第一个内部采样点之间线性插值，求 0.5 等值点作为亚像素端点
+        def edge(inner, outer):
+            outer_clipped = np.clip(outer, 0, len(d) - 1)
+            v_in = values[rows, inner]
+            v_out = np.where(outer == outer_clipped, values[rows, outer_clipped], 0.0)
+            span = v_in - v_out
+            t = np.divide(0.5 - v_out, span, out=np.ones_like(span), where=span != 0)
+            return d[outer_clipped] + t * (d[inner] - d[outer_clipped])
+        pos1 = edge(first, first - 1)
+        pos2 = edge(last, last + 1)
+        p1 = np.column_stack([points[:, 1] + pos1 * normal_dirs[:, 1], points[:, 0] + pos1 * normal_dirs[:, 0]])
+        p2 = np.column_stack([points[:, 1] + pos2 * normal_dirs[:, 1], points[:, 0] + pos2 * normal_dirs[:, 0]])
+    else:
+        p1 = np.column_stack([xs[rows, first], ys[rows, first]]).astype(float)
+        p2 = np.column_stack([xs[rows, last], ys[rows, last]]).astype(float)
+
+    delta = p1 - p2
+    diameters = np.sqrt(delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1])
+    diameters[~found] = 0
+    p1[~found] = np.nan
+    p2[~found] = np.nan
+    return diameters, p1, p2
+
+def measure_diameter(mask, point, normal_dir, length=100, subpixel=False): # Increased length for safety
+    diameters, p1, p2 = cast_rays(mask, point, normal_dir, length, subpixel=subpixel)
+    if np.isnan(p1[0, 0]):
+        return 0, None, None
+    cast = float if subpixel else int
+    return diameters[0], (cast(p1[0, 0]), cast(p1[0, 1])), (cast(p2[0, 0]), cast(p2[0, 1]))
+
+def split_label_mask(label_mask: np.ndarray):
+    """
+    一次广播比较数字标签掩码（1=AO, 2=DA, 3=TRA），同时得到三个结构的连续布尔掩码。
+    """
+    masks = np.asarray(label_mask)[None] == _CLASS_IDS[:, None, None]
+    return masks[0], masks[1], masks[2]
 
-    pts_ao = get_centerline(mask_ao)
-    pts_da = get_centerline(mask_da)
+def _measure_masks(mask_ao, mask_da, mask_tra, line_ao=None, line_da=None):
+    if not (mask_tra.any() and mask_ao.any() and mask_da.any()):
+        print("警告: 测量失败，掩码中缺少必要的结构。")
+        return None
+
+    with timing.stage("measure.centerline"):
+        if line_ao is None:
+            line_ao = Centerline.from_mask(mask_ao)
+        if line_da is None:
+            line_da = Centerline.from_mask(mask_da)
     pts_tra = np.column_stack(np.nonzero(mask_tra))
     
-    if pts_ao.size == 0 or pts_da.size == 0 or pts_tra.size == 0:
+    if len(line_ao) == 0 or len(line_da) == 0 or pts_tra.size == 0:
         print("警告: 测量失败，掩码中缺少必要的结构。")
         return None
 
-    center_tra = np.mean(pts_tra, axis=0)
-    dists = cdist(pts_ao, center_tra[None])
-    min_idx = np.argmin(dists)
-    P_a = pts_ao[min_idx]
-
-    normal_ao = compute_normal(pts_ao, min_idx)
-    diam_ao, _, _ = measure_diameter(mask_ao, P_a, normal_ao)
-
-    dists_da = cdist(pts_da, P_a[None])
-    min_idx_da = np.argmin(dists_da)
-    P_d = pts_da[min_idx_da]
+    with timing.stage("measure.rays"):
+        center_tra = np.mean(pts_tra, axis=0)
+        P_a, min_idx = line_ao.nearest(center_tra)
+        diam_ao, _, _ = measure_diameter(mask_ao, P_a, line_ao.normal(min_idx))
 
-    normal_da = compute_normal(pts_da, min_idx_da)
-    diam_da, _, _ = measure_diameter(mask_da, P_d, normal_da)
+        P_d, min_idx_da = line_da.nearest(P_a)
+        diam_da, _, _ = measure_diameter(mask_da, P_d, line_da.normal(min_idx_da))
 
     return {
         'diameter_AO': float(f"{diam_ao:.2f}"),
         'diameter_DA': float(f"{diam_da:.2f}")
-    }
\ No newline at end of file
+    }
+
+class CineLoopTracker:
+    """
+    逐帧测量 cine loop（动态视频）。以上一帧的 ROI 和中心线作为热启动：
+    若某一血管掩码仍完全落在上一次骨架化时的 ROI 内，且变化像素比例不超过 change_threshold，
+    则直接复用该中心线，只在新掩码上重新做射线测量，不再重新骨架化。
+    """
+
+    def __init__(self, change_threshold=CHANGE_THRESHOLD, margin=ROI_MARGIN):
+        self.change_threshold = change_threshold
+        self.margin = margin
+        self.skeletonized = 0
+        self.reused = 0
+        self._state = {}
+
+    def _centerline(self, name, mask):
+        state = self._state.get(name)
+        if state is not None and self._unchanged(mask, *state[:2]):
+            self.reused += 1
+            return state[2]
+        bbox = mask_bbox(mask, self.margin)
+        line = Centerline(get_centerline(mask, bbox=bbox) if bbox else np.empty((0, 2), dtype=np.intp))
+        # 只在重新骨架化时更新参考掩码，避免低于阈值的小变化逐帧累积
+        self._state[name] = (mask, bbox, line)
+        self.skeletonized += 1
+        return line
+
+    def _unchanged(self, mask, ref_mask, bbox):
+        if bbox is None or mask.shape != ref_mask.shape:
+            return False
+        y0, y1, x0, x1 = bbox
+        window = mask[y0:y1, x0:x1]
+        inside = np.count_nonzero(window)
+        if inside == 0 or inside != np.count_nonzero(mask):
+            return False
+        changed = np.count_nonzero(window ^ ref_mask[y0:y1, x0:x1])
+        return changed <= self.change_threshold * inside
+
+    def measure(self, label_mask: np.ndarray):
+        mask_ao, mask_da, mask_tra = split_label_mask(label_mask)
+        if not (mask_tra.any() and mask_ao.any() and mask_da.any()):
+            print("警告: 测量失败，掩码中缺少必要的结构。")
+            return None
+        return _measure_masks(mask_ao, mask_da, mask_tra,
+                              self._centerline('AO', mask_ao), self._centerline('DA', mask_da))
+
+def summarize_cine_loop(frame_results):
+    """
+    汇总整段 cine loop 的逐帧结果：有效帧数、各血管的最大直径及其所在帧、平均直径。
+    """
+    measured = [r for r in frame_results if r['diameter_AO'] is not None]
+    summary = {'frames': len(frame_results), 'measured_frames': len(measured)}
+    for key in ('diameter_AO', 'diameter_DA'):
+        if not measured:
+            summary[f'max_{key}'] = summary[f'max_{key}_frame'] = summary[f'mean_{key}'] = None
+            continue
+        best = max(measured, key=lambda r: r[key])
+        summary[f'max_{key}'] = best[key]
+        summary[f'max_{key}_frame'] = best['frame']
+        summary[f'mean_{key}'] = float(f"{np.mean([r[key] for r in measured]):.2f}")
+    return summary
+
+# --- 主入口函数 ---
+def measure_from_label_mask(label_mask: np.ndarray):
+    """
+    直接接收分割模型输出的数字标签掩码，执行测量并返回结果（无需先转换为彩色图）。
+    """
+    return _measure_masks(*split_label_mask(label_mask))
+
+def measure_from_color_mask(color_mask_pil: Image.Image):
+    """
+    接收一张彩色的PIL Image掩码，执行测量并返回结果。
+    """
+    img_rgb = np.array(color_mask_pil.convert("RGB"))
+
+    mask_ao = get_mask_from_rgb(img_rgb, [255, 0, 0])
+    mask_da = get_mask_from_rgb(img_rgb, [0, 255, 0])
+    mask_tra = get_mask_from_rgb(img_rgb, [0, 0, 255])
+
+    return _measure_masks(mask_ao, mask_da, mask_tra)
+
+def measure_label_stream(label_masks, change_threshold=CHANGE_THRESHOLD):
+    """
+    逐帧接收数字标签掩码（任意可迭代对象），以生成器形式返回每帧的测量结果。
+    相邻帧之间复用 ROI 与中心线，详见 CineLoopTracker。
+    """
+    tracker = CineLoopTracker(change_threshold)
+    for index, label_mask in enumerate(label_masks):
+        result = tracker.measure(label_mask)
+        yield {'frame': index, **(result or {'diameter_AO': None, 'diameter_DA': None})}
@@ -4,16 +4,50 @@ from PIL import Image
 import subprocess
 import os
 import shutil
+import threading
 import uuid
 import numpy as np
+from . import timing
 
 # --- 配置部分 ---
 DATASET_ID = 6
 CONFIGURATION = "2d"
 FOLD = 0
+CHECKPOINT_NAME = "checkpoint_best.pth"
 TEMP_FOLDER = os.path.abspath("./temp_io")
+# 训练好的模型目录（含 plans.json、dataset.json 与 fold_0/checkpoint_best.pth）
+MODEL_FOLDER = os.path.abspath("./checkpoints/Dataset006_3VV_New/nnUNetTrainer__nnUNetPlans__2d")
 # --- 配置结束 ---
 
+def load_predictor(model_folder=MODEL_FOLDER, fold=FOLD, checkpoint_name=CHECKPOINT_NAME):
+    """
+    在当前进程中加载 nnUNet 预测器（CPU），参数与命令行 -nps 1 --disable_tta 一致。
+    torch 与 nnunetv2 只在这里导入；缺少依赖或模型文件时抛出异常。
+    """
+    import torch
+    from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+
+    predictor = nnUNetPredictor(tile_step_size=0.5, use_gaussian=True, use_mirroring=False,
+                                perform_everything_on_device=False, device=torch.device("cpu"),
+                                verbose=False, verbose_preprocessing=False, allow_tqdm=False)
+    predictor.initialize_from_trained_model_folder(model_folder, use_folds=(fold,), checkpoint_name=checkpoint_name)
+    return predictor
+
+def image_to_nnunet_input(image_pil: Image.Image):
+    """
+    与 nnUNet 的 NaturalImage2DIO 读取 PNG 的结果相同：(3, 1, H, W) 的 float32 数组，spacing 为 (999, 1, 1)。
+    """
+    image = np.asarray(image_pil.convert("RGB")).transpose(2, 0, 1)[:, None].astype(np.float32)
+    return image, {'spacing': (999, 1, 1)}
+
+def segment_in_process(predictor, image_pil: Image.Image) -> np.ndarray:
+    """直接在内存中推理，返回 (H, W) 的 uint8 数字标签掩码，不写临时文件、不启动子进程。"""
+    with timing.stage("segment.prepare"):
+        image, properties = image_to_nnunet_input(image_pil)
+    with timing.stage("segment.inference"):
+        label_mask = predictor.predict_single_npy_array(image, properties, None, None, False)
+    return np.asarray(label_mask)[0].astype(np.uint8)
+
 def segment_with_command_line(image_pil: Image.Image) -> np.ndarray:
     task_id = str(uuid.uuid4())
     input_dir = os.path.join(TEMP_FOLDER, f"input_{task_id}")
@@ -23,9 +57,10 @@ def segment_with_command_line(image_pil: Image.Image) -> np.ndarray:
     os.makedirs(output_dir, exist_ok=True)
 
     try:
-        image_pil_rgb = image_pil.convert("RGB")
-        temp_input_filename = os.path.join(input_dir, "image_0000.png")
-        image_pil_rgb.save(temp_input_filename)
+        with timing.stage("segment.save_input"):
+            image_pil_rgb = image_pil.convert("RGB")
+            temp_input_filename = os.path.join(input_dir, "image_0000.png")
+            image_pil_rgb.save(temp_input_filename)
         
         command = [
             "nnUNetv2_predict", "-i", input_dir, "-o", output_dir, "-d", str(DATASET_ID),
@@ -38,7 +73,8 @@ def segment_with_command_line(image_pil: Image.Image) -> np.ndarray:
         
         print(f"正在执行命令: {' '.join(command)}")
         # 在Windows上使用 shell=True 来确保命令能被正确找到
-        subprocess.run(command, check=True, env=my_env, shell=True)
+        with timing.stage("segment.nnunet"):
+            subprocess.run(command, check=True, env=my_env, shell=True)
         print("nnUNetv2_predict 命令已执行。")
 
         output_image_path = os.path.join(output_dir, "image.png")
@@ -48,18 +84,40 @@ def segment_with_command_line(image_pil: Image.Image) -> np.ndarray:
         
         print(f"已找到输出文件: {output_image_path}")
         # 加载这张PNG，并将其作为单通道的Numpy数组返回
-        result_label_mask_pil = Image.open(output_image_path)
-        result_label_mask_np = np.array(result_label_mask_pil)
+        with timing.stage("segment.load_output"):
+            result_label_mask_pil = Image.open(output_image_path)
+            result_label_mask_np = np.array(result_label_mask_pil)
         return result_label_mask_np
     finally:
         print("正在清理临时文件...")
-        if os.path.exists(input_dir):
-            shutil.rmtree(input_dir)
-        if os.path.exists(output_dir):
-            shutil.rmtree(output_dir)
+        with timing.stage("segment.cleanup"):
+            if os.path.exists(input_dir):
+                shutil.rmtree(input_dir)
+            if os.path.exists(output_dir):
+                shutil.rmtree(output_dir)
         print("清理完毕。")
 
 
 class SegmentationModel:
+    """
+    创建时加载一次 nnUNet 预测器并常驻内存，之后每次 predict 都在进程内推理。
+    无法加载（未安装 torch/nnunetv2、缺少模型文件等）或 in_process=False 时，退回到逐次调用 nnUNetv2_predict 命令行。
+    """
+
+    def __init__(self, model_folder=MODEL_FOLDER, in_process=True):
+        self.predictor = None
+        # 预测器内部状态不是线程安全的，同一时刻只允许一个请求推理
+        self._lock = threading.Lock()
+        if in_process:
+            try:
+                with timing.stage("segment.load_model"):
+                    self.predictor = load_predictor(model_folder)
+                print(f"nnUNet 预测器已加载: {model_folder}")
+            except Exception as e:
+                print(f"无法在进程内加载 nnUNet 预测器，改用命令行预测: {e}")
+
     def predict(self, image_pil: Image.Image) -> np.ndarray:
-        return segment_with_command_line(image_pil)
\ No newline at end of file
+        if self.predictor is None:
+            return segment_with_command_line(image_pil)
+        with self._lock:
+            return segment_in_process(self.predictor, image_pil)
@@ -0,0 +1,82 @@
+# medical_agent_project/plugin/utils/timing.py
+
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# 设置环境变量 VESSELSEG_TIMING=1（或调用 enable()）后，所有请求的各阶段耗时都会累计到进程内统计中
+TIMING_ENV = "VESSELSEG_TIMING"
+
+_enabled = os.environ.get(TIMING_ENV, "") not in ("", "0")
+_local = threading.local()
+_totals = {}
+_totals_lock = threading.Lock()
+_NULL = nullcontext()
+
+def enable(on=True):
+    global _enabled
+    _enabled = bool(on)
+
+def enabled():
+    return _enabled
+
+def _add(table, name, wall, cpu):
+    entry = table.get(name)
+    if entry is None:
+        table[name] = {'calls': 1, 'wall': wall, 'cpu': cpu}
+    else:
+        entry['calls'] += 1
+        entry['wall'] += wall
+        entry['cpu'] += cpu
+
+class _Stage:
+    __slots__ = ('name', 'records', 'wall', 'cpu')
+
+    def __init__(self, name, records):
+        self.name = name
+        self.records = records
+
+    def __enter__(self):
+        self.cpu = time.thread_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        if self.records is not None:
+            _add(self.records, self.name, wall, cpu)
+        with _totals_lock:
+            _add(_totals, self.name, wall, cpu)
+        return False
+
+def stage(name):
+    """
+    记录一个阶段的墙钟时间与 CPU 时间（秒，CPU 为当前线程，不含 nnUNet 子进程）：
+        with timing.stage("segment.nnunet"): ...
+    未启用且当前线程没有 record() 时返回空上下文，几乎没有开销。
+    """
+    records = getattr(_local, 'records', None)
+    if records is None and not _enabled:
+        return _NULL
+    return _Stage(name, records)
+
+@contextmanager
+def record():
+    """在当前线程内收集本次调用各阶段的耗时：{stage: {'calls', 'wall', 'cpu'}}，同时计入进程内统计。"""
+    previous = getattr(_local, 'records', None)
+    _local.records = records = {}
+    try:
+        yield records
+    finally:
+        _local.records = previous
+
+def totals():
+    """进程启动（或上次 reset()）以来各阶段的累计耗时。"""
+    with _totals_lock:
+        return {name: dict(entry) for name, entry in _totals.items()}
+
+def reset():
+    with _totals_lock:
+        _totals.clear()
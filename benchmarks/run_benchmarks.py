@@ -0,0 +1,223 @@
+"""
+Times the measurement, evaluation and summary stages on synthetic data at several
+scales and compares them against benchmarks/baseline.json.
+
+    python benchmarks/run_benchmarks.py                    # run, write results.json, check the baseline
+    python benchmarks/run_benchmarks.py --quick            # smallest scales only
+    python benchmarks/run_benchmarks.py --update-baseline  # store this run as the new baseline
+
+Exits with status 1 when a stage is slower than its baseline by more than the tolerance.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [ROOT, os.path.join(ROOT, "3VV-agent"), BENCH_DIR]
+
+import synthetic
+from src import biometric, evaluate, summary
+from src.config import use_config
+
+IMAGE_SIZES = (256, 512, 1024)
+RECORD_COUNTS = (1000, 10000, 50000)
+QUICK_IMAGE_SIZES = (256,)
+QUICK_RECORD_COUNTS = (1000,)
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+DEFAULT_OUTPUT = os.path.join(BENCH_DIR, "results.json")
+# Synthetic inputs and stage outputs go to a tmpfs when there is one, so disk latency
+# does not end up in the timings.
+TMPFS = "/dev/shm"
+
+def scratch_dir():
+    return TMPFS if os.path.isdir(TMPFS) and os.access(TMPFS, os.W_OK) else None
+
+def write_config(work_dir):
+    # The synthetic tubes at 1024 px are wider than the default 30 px search, so the
+    # rays are long enough for every size (the plugin's default length).
+    config = {
+        "work_dir": work_dir,
+        "diameter_search_length": 100,
+        "roi_margin": 2,
+        "tangent_window": 3,
+        "workers": 1,
+        "groups_path": os.path.join(work_dir, "gold"),
+        "output_dir": os.path.join(work_dir, "output"),
+        "gold_cache": os.path.join(work_dir, "gold_standard_index.json"),
+        "deviation_json": False,
+        "outlier_threshold": 1000,
+    }
+    os.makedirs(config["output_dir"], exist_ok=True)
+    path = os.path.join(work_dir, "config.yaml")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)  # JSON is valid YAML
+    use_config(path)
+
+def time_call(fn, repeat, min_time=0.2):
+    """
+    Seconds per call of ``fn()``: one warm-up call, then ``repeat`` timed samples, each
+    looping enough calls to last about ``min_time`` so fast stages are not timer noise.
+    """
+    start = time.perf_counter()
+    fn()
+    first = time.perf_counter() - start
+    number = max(1, int(min_time / first)) if first > 0 else 1000
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+    return {"min": min(samples), "median": statistics.median(samples), "calls": number, "repeat": repeat}
+
+def measurement_cases(work_dir, sizes, curvature, seed):
+    from plugin.utils.measurement import measure_from_color_mask
+    from plugin.utils.postprocessing import convert_label_to_color_mask
+
+    for size in sizes:
+        labels = synthetic.make_label_mask(size, curvature, seed)
+        mask_ao = labels == synthetic.AO
+        line = biometric.Centerline.from_mask(mask_ao)
+        point, idx = line.nearest(np.argwhere(labels == synthetic.TRA).mean(axis=0))
+        normal = line.normal(idx)
+        diameter, _, _ = biometric.measure_diameter(mask_ao, point, normal)
+        if diameter <= 0:
+            raise RuntimeError(f"synthetic {size}px mask has no measurable aorta")
+        path, = synthetic.write_prediction_folder(os.path.join(work_dir, f"pred_{size}"), 1, size, curvature, seed)
+        color_mask = convert_label_to_color_mask(labels)
+
+        yield f"get_centerline@{size}px", lambda: biometric.get_centerline(mask_ao)
+        yield f"measure_diameter@{size}px", lambda: biometric.measure_diameter(mask_ao, point, normal)
+        yield f"process_image@{size}px", lambda: biometric.process_image(path)
+        yield f"convert_label_to_color_mask@{size}px", lambda: convert_label_to_color_mask(labels)
+        yield f"measure_from_color_mask@{size}px", lambda: measure_from_color_mask(color_mask)
+
+def record_cases(work_dir, counts, seed):
+    output_dir = evaluate.setting('OUTPUT_DIR')
+    for count in counts:
+        groups_path = os.path.join(work_dir, f"eval_{count}")
+        csv_path, _ = synthetic.write_evaluation_inputs(groups_path, count, seed)
+        gold = evaluate.GoldStandard(evaluate.load_gold_standard(groups_path, cache_path=""))
+        records = synthetic.make_deviation_records(count, evaluate.METRIC_NAMES, seed)
+
+        yield (f"evaluate.process_one_model@{count}",
+               lambda csv_path=csv_path, gold=gold: evaluate.process_one_model(csv_path, "bench", gold, output_dir))
+        yield f"summary.calculate_global_averages@{count}", lambda records=records: summary.calculate_global_averages(records)
+
+def run(sizes, counts, curvature=0.15, repeat=5, seed=0, only=None):
+    results = {}
+    with tempfile.TemporaryDirectory(dir=scratch_dir()) as work_dir, open(os.devnull, "w") as devnull:
+        write_config(work_dir)
+        cases = [measurement_cases(work_dir, sizes, curvature, seed), record_cases(work_dir, counts, seed)]
+        for stages in cases:
+            for name, fn in stages:
+                if only and not any(name.startswith(prefix) for prefix in only):
+                    continue
+                # The stages' progress messages are silenced around the whole measurement
+                with contextlib.redirect_stdout(devnull):
+                    results[name] = time_call(fn, repeat)
+                print(f"{name:45s} {results[name]['min'] * 1e3:10.3f} ms  (median {results[name]['median'] * 1e3:.3f} ms)")
+    return results
+
+def metadata(args):
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "curvature": args.curvature,
+        "repeat": args.repeat,
+        "seed": args.seed,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+def compare(results, baseline, tolerance, slack, short_tolerance=2.0, short_time=0.02):
+    """
+    Stages whose median time exceeds ``tolerance`` x the baseline median plus ``slack``
+    seconds, as (name, current, baseline). Stages whose baseline median is under
+    ``short_time`` seconds swing more with machine load and use ``short_tolerance``;
+    stages missing from the baseline are skipped.
+    """
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            print(f"{name}: no baseline")
+            continue
+        factor = short_tolerance if reference["median"] < short_time else tolerance
+        if result["median"] > reference["median"] * factor + slack:
+            regressions.append((name, result["median"], reference["median"]))
+    return regressions
+
+def save_json(data, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the 3VV pipeline stages on synthetic masks.")
+    parser.add_argument("--quick", action="store_true", help="only the smallest image size and record count")
+    parser.add_argument("--sizes", type=int, nargs="+", help=f"image sizes in pixels (default: {IMAGE_SIZES})")
+    parser.add_argument("--records", type=int, nargs="+", help=f"image counts for evaluate/summary (default: {RECORD_COUNTS})")
+    parser.add_argument("--only", nargs="+", help="run only stages whose name starts with one of these")
+    parser.add_argument("--curvature", type=float, default=0.15, help="bend of the synthetic vessels (default: 0.15)")
+    parser.add_argument("--repeat", type=int, default=5, help="timed samples per stage (default: 5)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="machine-readable results file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update-baseline", action="store_true", help="store this run as the baseline instead of checking it")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="allowed slowdown factor of the median over the baseline (default: 1.5)")
+    parser.add_argument("--short-tolerance", type=float, default=2.0,
+                        help="allowed slowdown factor for stages under --short-time (default: 2.0)")
+    parser.add_argument("--short-time", type=float, default=0.02,
+                        help="baseline median in seconds below which --short-tolerance applies (default: 0.02)")
+    parser.add_argument("--slack", type=float, default=0.0002,
+                        help="absolute slack in seconds added to the threshold (default: 0.0002)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = args.sizes or (QUICK_IMAGE_SIZES if args.quick else IMAGE_SIZES)
+    counts = args.records or (QUICK_RECORD_COUNTS if args.quick else RECORD_COUNTS)
+    results = run(sizes, counts, args.curvature, args.repeat, args.seed, args.only)
+    report = {"meta": metadata(args), "results": results}
+    save_json(report, args.output)
+    print(f"Results saved in {args.output}")
+
+    if args.update_baseline:
+        baseline = {"meta": report["meta"], "results": {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                baseline["results"] = json.load(f)["results"]
+        baseline["results"].update(results)
+        save_json(baseline, args.baseline)
+        print(f"Baseline updated: {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --update-baseline to create one.")
+        return 0
+
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.tolerance, args.slack, args.short_tolerance, args.short_time)
+    for name, current, reference in regressions:
+        print(f"REGRESSION {name}: median {current * 1e3:.3f} ms vs baseline {reference * 1e3:.3f} ms")
+    if regressions:
+        return 1
+    print(f"No regressions (median within x{args.tolerance}, x{args.short_tolerance} under "
+          f"{args.short_time * 1e3:.0f} ms, + {args.slack * 1e3:.2f} ms)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""
+Synthetic 3VV prediction masks for the benchmarks: the aorta (AO) and pulmonary
+artery (PA) as curved tubes and the trachea (TRA) as a short blob next to them,
+drawn at any resolution without real images or a segmentation model.
+"""
+import csv
+import json
+import os
+
+import cv2
+import numpy as np
+
+# Same label ids and colors as biometric.CLASS_COLORS / plugin postprocessing
+AO, PA, TRA = 1, 2, 3
+CLASS_COLORS = {AO: (255, 0, 0), PA: (0, 255, 0), TRA: (0, 0, 255)}
+
+def tube_centerline(start, end, curvature, samples=64):
+    """
+    Points along a quadratic Bezier from ``start`` to ``end`` (x, y); ``curvature`` is
+    the sideways offset of the control point as a fraction of the tube length.
+    """
+    start, end = np.asarray(start, dtype=float), np.asarray(end, dtype=float)
+    direction = end - start
+    normal = np.array([-direction[1], direction[0]])
+    control = (start + end) / 2 + curvature * normal
+    t = np.linspace(0, 1, samples)[:, None]
+    return (1 - t) ** 2 * start + 2 * (1 - t) * t * control + t ** 2 * end
+
+def draw_tube(labels, centerline, radius, label):
+    cv2.polylines(labels, [np.round(centerline).astype(np.int32)], False, int(label),
+                  thickness=max(1, int(round(2 * radius))), lineType=cv2.LINE_8)
+
+def make_label_mask(size=512, curvature=0.15, rng=None):
+    """
+    One (size, size) uint8 label mask: AO and PA tubes running diagonally side by side
+    with radii proportional to the image size, and TRA between their upper ends.
+    """
+    rng = np.random.default_rng(rng)
+    labels = np.zeros((size, size), dtype=np.uint8)
+    jitter = lambda: rng.uniform(-0.03, 0.03, 2) * size
+    bend = curvature * rng.uniform(0.8, 1.2)
+    ao = tube_centerline(np.array([0.30, 0.20]) * size + jitter(), np.array([0.55, 0.85]) * size + jitter(), bend)
+    pa = tube_centerline(np.array([0.50, 0.15]) * size + jitter(), np.array([0.80, 0.75]) * size + jitter(), -bend)
+    draw_tube(labels, ao, size * rng.uniform(0.025, 0.035), AO)
+    draw_tube(labels, pa, size * rng.uniform(0.030, 0.040), PA)
+    tra_center = np.array([0.45, 0.45]) * size + jitter()
+    cv2.circle(labels, tuple(int(v) for v in tra_center), int(size * 0.03), TRA, -1)
+    return labels
+
+def label_to_rgb(labels):
+    rgb = np.zeros(labels.shape + (3,), dtype=np.uint8)
+    for label, color in CLASS_COLORS.items():
+        rgb[labels == label] = color
+    return rgb
+
+def write_prediction_folder(folder, count, size, curvature=0.15, seed=0):
+    """Writes ``count`` color prediction PNGs (as nnUNet + postprocessing would) and returns their paths."""
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, f"{i:05d}.png")
+        cv2.imwrite(path, cv2.cvtColor(label_to_rgb(make_label_mask(size, curvature, rng)), cv2.COLOR_RGB2BGR))
+        paths.append(path)
+    return paths
+
+def write_evaluation_inputs(folder, count, seed=0):
+    """
+    Writes a biometric-style measurement CSV for ``count`` images and the matching
+    group1-3.json expert annotations; returns (csv path, groups folder).
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    names = [f"{i:06d}" for i in range(count)]
+
+    def line(center, diameter):
+        angle = rng.uniform(0, np.pi)
+        offset = diameter / 2 * np.array([np.cos(angle), np.sin(angle)])
+        return np.concatenate([center - offset, center + offset])
+
+    centers = rng.uniform(100, 400, (count, 2, 2))   # (image, vessel, xy)
+    diameters = rng.uniform(15, 35, (count, 2))
+    for g in (1, 2, 3):
+        items = []
+        for n, name in enumerate(names):
+            annotations = [
+                {'label_id': label_id, 'points': line(centers[n, v] + rng.normal(0, 1.5, 2),
+                                                     diameters[n, v] + rng.normal(0, 1.0)).tolist()}
+                for label_id, v in ((1, 0), (0, 1))
+            ]
+            items.append({'id': f"images/{name}_0000.png", 'annotations': annotations})
+        with open(os.path.join(folder, f"group{g}.json"), 'w', encoding='utf-8') as f:
+            json.dump({'items': items}, f)
+
+    csv_path = os.path.join(folder, "measurements.csv")
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['filename', 'diameter_AO', 'AO_point1_x', 'AO_point1_y', 'AO_point2_x', 'AO_point2_y',
+                         'diameter_PA', 'PA_point1_x', 'PA_point1_y', 'PA_point2_x', 'PA_point2_y'])
+        for n, name in enumerate(names):
+            row = [f"{name}.png"]
+            for v in range(2):
+                measured = diameters[n, v] + rng.normal(0, 2.0)
+                row += [round(measured, 2)] + [int(c) for c in line(centers[n, v] + rng.normal(0, 3, 2), measured)]
+            writer.writerow(row)
+    return csv_path, folder
+
+def make_deviation_records(count, metrics, seed=0, missing=0.05, outliers=0.01):
+    """{image: {metric: error}} records like evaluate's deviation JSON, with some gaps and outliers."""
+    rng = np.random.default_rng(seed)
+    values = rng.gamma(2.0, 3.0, (count, len(metrics)))
+    values[rng.random(values.shape) < outliers] = 5000.0
+    present = rng.random(values.shape) >= missing
+    return {
+        f"{i:06d}.png": {metric: float(v) for metric, v, keep in zip(metrics, row, mask) if keep}
+        for i, (row, mask) in enumerate(zip(values, present))
+    }
@@ -1,22 +1,101 @@
 from . import biometric
 from . import evaluate
 from . import summary
+from .config import load_config
 import os
-import yaml
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 
-def run_all():
+def _written(rows, writer):
+    for row in rows:
+        writer.write(row)
+        yield row
+
+def run_fused(write_artifacts=False):
+    """
+    Runs the pipeline as one in-memory stream per model: measurement rows go straight
+    into evaluation, and the summary is computed from the evaluated tables in memory.
+    Every model_files model is summarized, as in a staged run; models this run does not
+    measure (with a single input_folder, all but one) are evaluated from their existing
+    CSV. With write_artifacts the measurement CSV/JSON and the deviation tables are
+    also written, exactly as the staged pipeline would.
+    """
+    gold = evaluate.GoldStandard(evaluate.load_gold_standard())
+    targets = biometric.measurement_targets()
+    model_files = evaluate.setting('MODEL_FILES')
+    models = list(model_files) + [model for model in targets if model not in model_files]
+    workers = biometric.setting('WORKERS')
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    tables = {}
+    try:
+        # Start every model's measurements before consuming any, so the pool stays busy
+        runs = {model: biometric.MeasurementRun(folder_path, output_csv, biometric.setting('VISUALIZE'), workers,
+                                                biometric.setting('RESUME'), pool)
+                for model, (folder_path, output_csv) in targets.items()}
+        for model in models:
+            print(f"\n--- {model} ---")
+            writer = None
+            if model in runs:
+                rows = runs[model].rows()
+                if write_artifacts:
+                    writer = biometric.ResultWriter(runs[model].output_csv,
+                                                    os.path.splitext(runs[model].output_csv)[0] + '.json')
+                    rows = _written(rows, writer)
+            elif os.path.exists(model_files[model]):
+                print(f"[{model}] not measured in this run; evaluating {model_files[model]}")
+                rows = evaluate.iter_rows(model_files[model])
+            else:
+                print(f"[{model}] no measurements found at {model_files[model]}; skipping")
+                continue
+
+            image_names, errors, lengths = [], [], []
+            try:
+                for batch_names, table, batch_lengths in evaluate.iter_evaluated_batches(rows, gold):
+                    image_names += batch_names
+                    # The float32 values the deviation table stores, so staged and fused runs agree
+                    errors.append(table.astype(np.float32))
+                    lengths.append(batch_lengths.astype(np.float32))
+            finally:
+                if writer is not None:
+                    writer.close()
+            if writer is not None:
+                writer.finalize()
+
+            table = np.concatenate(errors) if errors else np.empty((0, len(evaluate.METRIC_NAMES)), np.float32)
+            lengths = np.concatenate(lengths) if lengths else np.empty((0, len(evaluate.RATERS), 2), np.float32)
+            if write_artifacts:
+                evaluate.save_deviation_table(evaluate.deviation_path(evaluate.setting('OUTPUT_DIR'), model),
+                                              image_names, table, lengths)
+            tables[model] = (image_names, evaluate.METRIC_NAMES, table)
+            # Statistics come from the whole table, in the same batches as summary.py uses
+            summary.write_model_summary(model, evaluate.METRIC_NAMES, table,
+                                        (list(evaluate.RATERS), list(evaluate.VESSELS), lengths.astype(np.float64)))
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+    summary.write_model_differences(tables)
+
+def run_all(fused=False, write_artifacts=False):
     """
     Runs the entire evaluation pipeline in sequence:
     1. Biometric measurement (biometric.py)
     2. Model evaluation (evaluate.py)
     3. Results summary (summary.py)
+    With fused=True the stages run as one in-memory stream instead (see run_fused).
     """
+    if fused:
+        print("--- Starting fused pipeline ---")
+        run_fused(write_artifacts)
+        print("All processes completed successfully.")
+        return
+
     print("--- Starting biometric measurement ---")
-    biometric.main()
+    # An empty argv: the host process's own arguments (notebooks, other CLIs) are not ours
+    biometric.main([])
     print("--- Biometric measurement finished ---\n")
 
     print("--- Starting model evaluation ---")
-    evaluate.main()
+    evaluate.main([])
     print("--- Model evaluation finished ---\n")
 
     print("--- Starting results summary ---")
@@ -31,9 +110,6 @@ if __name__ == '__main__':
     # When __init__.py is run, its path is src/__init__.py
     # We need to change the working directory to the parent directory.
     # Get the absolute path of config.yaml
-    with open("config.yaml", "r", encoding="utf-8") as f:
-        cfg = yaml.safe_load(f)
-    work_dir = cfg["work_dir"]
-    os.chdir(work_dir)
-    
+    os.chdir(load_config()["work_dir"])
+
     run_all()
@@ -1,138 +1,945 @@
 import os
-import cv2
 import numpy as np
-import matplotlib.pyplot as plt
-from skimage.morphology import skeletonize
-from scipy.spatial.distance import cdist
 import csv
 import json
-import yaml
+import argparse
+import hashlib
+import textwrap
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+# cv2, skimage, scipy and PIL are imported where they are first needed, so that
+# importing this module (or the src package) stays cheap.
 
-with open("config.yaml", "r") as f:
-    cfg = yaml.safe_load(f)
+try:
+    from .config import settings_accessors
+    from . import timing
+except ImportError:  # run as a script from src/
+    from config import settings_accessors
+    import timing
 
-WORK_DIR = cfg["work_dir"]
-INPUT_FOLDER = cfg["input_folder"]
-OUTPUT_CSV = os.path.join(WORK_DIR, cfg["output_csv"])
-OUTPUT_JSON = os.path.join(WORK_DIR, cfg["output_json"])
-VISUALIZE = cfg["visualize"]
-DIAM_LEN = cfg["diameter_search_length"]
+_SETTINGS = {
+    'WORK_DIR': lambda cfg: cfg["work_dir"],
+    'INPUT_FOLDER': lambda cfg: cfg["input_folder"],
+    'INPUT_FOLDERS': lambda cfg: cfg.get("input_folders") or {},
+    'MODEL_FILES': lambda cfg: cfg.get("model_files") or {},
+    'OUTPUT_CSV': lambda cfg: os.path.join(cfg["work_dir"], cfg["output_csv"]),
+    'OUTPUT_JSON': lambda cfg: os.path.join(cfg["work_dir"], cfg["output_json"]),
+    'VISUALIZE': lambda cfg: cfg.get("visualize", False),
+    'DIAM_LEN': lambda cfg: cfg.get("diameter_search_length", 30),
+    'ROI_MARGIN': lambda cfg: cfg.get("roi_margin", 2),
+    'TANGENT_WINDOW': lambda cfg: cfg.get("tangent_window", 3),
+    'WORKERS': lambda cfg: cfg.get("workers", 1),
+    'RESUME': lambda cfg: cfg.get("resume", True),
+}
+setting, __getattr__ = settings_accessors(__name__, _SETTINGS)
+
+# Bump whenever the measurement algorithm changes so resumable runs re-measure everything
+MEASUREMENT_VERSION = 2
+
+# Label ids shared with the plugin's postprocessing: 1=AO (red), 2=PA (green), 3=TRA (blue)
+CLASS_COLORS = {1: (255, 0, 0), 2: (0, 255, 0), 3: (0, 0, 255)}
+_CLASS_IDS = np.array(list(CLASS_COLORS), dtype=np.uint8)
+_COLOR_KEYS = np.array([(r << 16) | (g << 8) | b for r, g, b in CLASS_COLORS.values()], dtype=np.uint32)
 
 def get_mask_from_rgb(img_rgb, color):
     return np.all(img_rgb == color, axis=-1)
 
-def get_centerline(mask):
-    skeleton = skeletonize(mask > 0)
-    return np.column_stack(np.nonzero(skeleton))
+def mask_bbox(mask, margin=0):
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    y0 = max(rows[0] - margin, 0)
+    x0 = max(cols[0] - margin, 0)
+    y1 = min(rows[-1] + margin + 1, mask.shape[0])
+    x1 = min(cols[-1] + margin + 1, mask.shape[1])
+    return y0, y1, x0, x1
+
+def stack_bboxes(masks, margin=0):
+    # mask_bbox for every frame of an (N, H, W) stack at once; rows of -1 mark empty frames
+    n, h, w = masks.shape
+    rows = masks.any(axis=2)
+    cols = masks.any(axis=1)
+    bboxes = np.column_stack([
+        np.maximum(np.argmax(rows, axis=1) - margin, 0),
+        np.minimum(h - np.argmax(rows[:, ::-1], axis=1) + margin, h),
+        np.maximum(np.argmax(cols, axis=1) - margin, 0),
+        np.minimum(w - np.argmax(cols[:, ::-1], axis=1) + margin, w),
+    ])
+    bboxes[~rows.any(axis=1)] = -1
+    return bboxes
+
+def get_centerline(mask, margin=None, bbox=None):
+    from skimage.morphology import skeletonize
+    if bbox is None:
+        bbox = mask_bbox(mask, setting('ROI_MARGIN') if margin is None else margin)
+    if bbox is None:
+        return np.empty((0, 2), dtype=np.intp)
+    y0, y1, x0, x1 = bbox
+    skeleton = skeletonize(mask[y0:y1, x0:x1] > 0)
+    return np.column_stack(np.nonzero(skeleton)) + (y0, x0)
 
 def closest_point(centerline, ref_point):
-    dists = cdist(centerline, ref_point[None])
-    idx = np.argmin(dists)
+    if isinstance(centerline, Centerline):
+        return centerline.nearest(ref_point)
+    from scipy.spatial import cKDTree
+    _, idx = cKDTree(centerline).query(ref_point)
     return centerline[idx], idx
 
-def compute_normal(centerline, idx):
-    if len(centerline) < 2:
-        return np.array([1, 0])
-    if idx == 0:
-        p1, p2 = centerline[idx], centerline[idx + 1]
-    elif idx == len(centerline) - 1:
-        p1, p2 = centerline[idx - 1], centerline[idx]
+# 4-connected offsets first, so walks step through staircase corners instead of cutting them
+_NEIGHBOR_OFFSETS = np.array([(-1, 0), (0, -1), (0, 1), (1, 0), (-1, -1), (-1, 1), (1, -1), (1, 1)])
+
+def order_skeleton(points):
+    """Order skeleton pixels into 8-connected paths.
+
+    Returns the reordered points and the start offset of every path. Walks begin at
+    endpoints, so each branch of a forked skeleton becomes its own path.
+    """
+    n = len(points)
+    if n == 0:
+        return points, np.zeros(0, dtype=np.intp)
+    origin = points.min(axis=0) - 1
+    local = points - origin
+    grid = np.full(tuple(local.max(axis=0) + 2), -1, dtype=np.intp)
+    grid[local[:, 0], local[:, 1]] = np.arange(n)
+    neighbors = grid[local[:, None, 0] + _NEIGHBOR_OFFSETS[:, 0], local[:, None, 1] + _NEIGHBOR_OFFSETS[:, 1]]
+    degree = (neighbors >= 0).sum(axis=1)
+
+    neighbors = neighbors.tolist()
+    visited = [False] * n
+    order = []
+    starts = []
+    # Endpoints and isolated pixels seed first; whatever is left lies on closed loops
+    for seed in np.concatenate([np.flatnonzero(degree <= 1), np.arange(n)]).tolist():
+        if visited[seed]:
+            continue
+        starts.append(len(order))
+        current = seed
+        while current >= 0:
+            visited[current] = True
+            order.append(current)
+            current = next((j for j in neighbors[current] if j >= 0 and not visited[j]), -1)
+    return points[order], np.array(starts, dtype=np.intp)
+
+class Centerline:
+    """A vessel skeleton ordered into connected paths, with a precomputed normal per point.
+
+    Tangents are central differences over ``window`` points along each path, so
+    ``normals[idx]`` is an O(1) lookup that follows the vessel rather than raster order.
+    """
+
+    def __init__(self, points, window=None):
+        self.points, self.path_starts = order_skeleton(np.asarray(points))
+        self.tangents, self.normals = self._tangent_field(setting('TANGENT_WINDOW') if window is None else window)
+        self._tree = None
+
+    @classmethod
+    def from_mask(cls, mask, margin=None, window=None):
+        return cls(get_centerline(mask, margin), window)
+
+    def __len__(self):
+        return len(self.points)
+
+    def normal(self, idx):
+        return self.normals[idx]
+
+    @property
+    def tree(self):
+        # Built on first use and shared by every query against this centerline
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+            self._tree = cKDTree(self.points)
+        return self._tree
+
+    def nearest(self, ref_points, k=1):
+        """Nearest ``k`` centerline points to one (y, x) point or an (M, 2) batch of them.
+
+        Returns ``(points, idx)``; with ``k > 1`` both gain a trailing axis of size ``k``.
+        """
+        _, idx = self.tree.query(ref_points, k=k)
+        return self.points[idx], idx
+
+    def _tangent_field(self, window):
+        n = len(self.points)
+        if n == 0:
+            return np.zeros((0, 2)), np.zeros((0, 2))
+        lengths = np.diff(np.append(self.path_starts, n))
+        first = np.repeat(self.path_starts, lengths)
+        last = first + np.repeat(lengths, lengths) - 1
+        pos = np.arange(n)
+        lo = np.maximum(pos - window, first)
+        hi = np.minimum(pos + window, last)
+        tangents = (self.points[hi] - self.points[lo]).astype(float)
+        normals = np.column_stack([-tangents[:, 1], tangents[:, 0]])
+        norms = np.hypot(normals[:, 0], normals[:, 1])
+        degenerate = norms == 0
+        normals[degenerate] = (1, 0)
+        norms[degenerate] = 1
+        return tangents, normals / norms[:, None]
+
+def _sample_mask(mask, frames, ys, xs, offsets=None):
+    # Integer samples; anything outside the frame reads as background. ``offsets``
+    # (one (y, x) row per ray) places a cropped mask inside the full image.
+    if offsets is not None:
+        ys = ys - offsets[:, 0:1]
+        xs = xs - offsets[:, 1:2]
+    h, w = mask.shape[-2:]
+    inside = (ys >= 0) & (ys < h) & (xs >= 0) & (xs < w)
+    hits = np.zeros(ys.shape, dtype=bool)
+    if frames is None:
+        hits[inside] = mask[ys[inside], xs[inside]]
+    else:
+        hits[inside] = mask[np.broadcast_to(frames[:, None], ys.shape)[inside], ys[inside], xs[inside]]
+    return hits
+
+def _sample_bilinear(mask, frames, ys, xs, offsets=None):
+    y0 = np.floor(ys).astype(int)
+    x0 = np.floor(xs).astype(int)
+    fy = ys - y0
+    fx = xs - x0
+    values = np.zeros(ys.shape)
+    for dy, wy in ((0, 1 - fy), (1, fy)):
+        for dx, wx in ((0, 1 - fx), (1, fx)):
+            values += wy * wx * _sample_mask(mask, frames, y0 + dy, x0 + dx, offsets)
+    return values
+
+def cast_rays(mask, points, normal_dirs, length=None, subpixel=False, step=0.25, frames=None, offsets=None):
+    """Cast one ray per (point, normal) pair across ``mask`` in a single array pass.
+
+    ``points`` and ``normal_dirs`` are (y, x) rows and broadcast against each other,
+    so one point with several normals (or several points with one normal) works too.
+    Returns ``(diameters, p1, p2)`` where the endpoints are (x, y) rows, NaN for rays
+    that hit fewer than two mask samples.
+
+    With ``frames`` (one frame index per ray), ``mask`` is an (N, H, W) stack and
+    rays from different frames are cast in the same pass. With ``offsets`` (one (y, x)
+    row per ray) ``mask`` is a crop whose top-left corner sits at that image position;
+    points and endpoints stay in full-image coordinates.
+    """
+    if length is None:
+        length = setting('DIAM_LEN')
+    points = np.atleast_2d(np.asarray(points, dtype=float))
+    normal_dirs = np.atleast_2d(np.asarray(normal_dirs, dtype=float))
+    points, normal_dirs = np.broadcast_arrays(points, normal_dirs)
+    n_rays = len(points)
+    if subpixel:
+        d = np.arange(-length, length, step, dtype=float)
+        origin = points
+    else:
+        d = np.arange(-length, length)
+        origin = np.trunc(points)
+    ys = origin[:, 0:1] + d[None] * normal_dirs[:, 0:1]
+    xs = origin[:, 1:2] + d[None] * normal_dirs[:, 1:2]
+
+    if frames is not None:
+        frames = np.asarray(frames, dtype=np.intp)
+    if offsets is not None:
+        offsets = np.broadcast_to(np.asarray(offsets, dtype=int).reshape(-1, 2), (n_rays, 2))
+    if subpixel:
+        values = _sample_bilinear(mask, frames, ys, xs, offsets)
+        hits = values >= 0.5
+    else:
+        ys = np.trunc(ys).astype(int)
+        xs = np.trunc(xs).astype(int)
+        hits = _sample_mask(mask, frames, ys, xs, offsets)
+
+    found = hits.sum(axis=1) >= 2
+    first = np.argmax(hits, axis=1)
+    last = hits.shape[1] - 1 - np.argmax(hits[:, ::-1], axis=1)
+    rows = np.arange(n_rays)
+
+    if subpixel:
+        # Refine each endpoint to the 0.5 iso-crossing between the last outside sample
+        # and the first inside one.
+        def edge(inner, outer):
+            outer_clipped = np.clip(outer, 0, len(d) - 1)
+            v_in = values[rows, inner]
+            v_out = np.where(outer == outer_clipped, values[rows, outer_clipped], 0.0)
+            span = v_in - v_out
+            t = np.divide(0.5 - v_out, span, out=np.ones_like(span), where=span != 0)
+            return d[outer_clipped] + t * (d[inner] - d[outer_clipped])
+        pos1 = edge(first, first - 1)
+        pos2 = edge(last, last + 1)
+        p1 = np.column_stack([points[:, 1] + pos1 * normal_dirs[:, 1], points[:, 0] + pos1 * normal_dirs[:, 0]])
+        p2 = np.column_stack([points[:, 1] + pos2 * normal_dirs[:, 1], points[:, 0] + pos2 * normal_dirs[:, 0]])
     else:
-        p1, p2 = centerline[idx - 1], centerline[idx + 1]
-    tangent = p2 - p1
-    normal = np.array([-tangent[1], tangent[0]])
-    norm = np.linalg.norm(normal)
-    return normal / norm if norm != 0 else np.array([1, 0])
-
-def measure_diameter(mask, point, normal_dir, length=DIAM_LEN):
-    y0, x0 = point.astype(int)
-    coords = []
-    for d in range(-length, length):
-        x = int(x0 + d * normal_dir[1])
-        y = int(y0 + d * normal_dir[0])
-        if 0 <= y < mask.shape[0] and 0 <= x < mask.shape[1]:
-            if mask[y, x]:
-                coords.append((x, y))
-    if len(coords) >= 2:
-        p1, p2 = coords[0], coords[-1]
-        return np.linalg.norm(np.array(p1) - np.array(p2)), p1, p2
-    return 0, None, None
-
-def process_image(path, visualize=False):
-    img = cv2.imread(path)
+        p1 = np.column_stack([xs[rows, first], ys[rows, first]]).astype(float)
+        p2 = np.column_stack([xs[rows, last], ys[rows, last]]).astype(float)
+
+    delta = p1 - p2
+    diameters = np.sqrt(delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1])
+    diameters[~found] = 0
+    p1[~found] = np.nan
+    p2[~found] = np.nan
+    return diameters, p1, p2
+
+def measure_diameter(mask, point, normal_dir, length=None, subpixel=False):
+    diameters, p1, p2 = cast_rays(mask, point, normal_dir, length, subpixel=subpixel)
+    if np.isnan(p1[0, 0]):
+        return 0, None, None
+    cast = float if subpixel else int
+    return diameters[0], (cast(p1[0, 0]), cast(p1[0, 1])), (cast(p2[0, 0]), cast(p2[0, 1]))
+
+def pack_rgb(img, bgr=False):
+    r, b = (2, 0) if bgr else (0, 2)
+    return (img[..., r].astype(np.uint32) << 16) | (img[..., 1].astype(np.uint32) << 8) | img[..., b]
+
+def decode_color_mask(img, bgr=False):
+    hits = pack_rgb(img, bgr)[None] == _COLOR_KEYS[:, None, None]
+    labels = np.zeros(hits.shape[1:], dtype=np.uint8)
+    for class_id, hit in zip(_CLASS_IDS, hits):
+        labels += hit * class_id
+    return labels
+
+def split_label_mask(labels):
+    # One broadcast comparison yields contiguous AO, PA and TRA masks
+    masks = labels[None] == _CLASS_IDS.reshape((-1,) + (1,) * labels.ndim)
+    return masks[0], masks[1], masks[2]
+
+def _measure_masks(mask_ao, mask_pa, mask_tra):
+    if not (mask_tra.any() and mask_ao.any() and mask_pa.any()):
+        return (None, None, None, None, None, None), None
+    with timing.stage("centerline"):
+        line_ao = Centerline.from_mask(mask_ao)
+        line_pa = Centerline.from_mask(mask_pa)
+    pts_tra = np.column_stack(np.nonzero(mask_tra))
+    if len(line_ao) == 0 or len(line_pa) == 0 or pts_tra.size == 0:
+        return (None, None, None, None, None, None), None
+    with timing.stage("rays"):
+        center_tra = np.mean(pts_tra, axis=0)
+        P_a, min_idx = line_ao.nearest(center_tra)
+        diam_ao, p1_ao, p2_ao = measure_diameter(mask_ao, P_a, line_ao.normal(min_idx))
+        P_p, min_idx_pa = line_pa.nearest(P_a)
+        diam_pa, p1_pa, p2_pa = measure_diameter(mask_pa, P_p, line_pa.normal(min_idx_pa))
+    return (diam_ao, diam_pa, p1_ao, p2_ao, p1_pa, p2_pa), center_tra
+
+def measure_label_mask(labels):
+    measurements, _ = _measure_masks(*split_label_mask(labels))
+    return measurements
+
+MEASURE_FIELDS = [
+    'diameter_AO', 'AO_point1_x', 'AO_point1_y', 'AO_point2_x', 'AO_point2_y',
+    'diameter_PA', 'PA_point1_x', 'PA_point1_y', 'PA_point2_x', 'PA_point2_y',
+]
+MEASURE_DTYPE = np.dtype([(name, np.float64) for name in MEASURE_FIELDS] + [('valid', bool)])
+
+def _label_batches(label_masks, batch_size):
+    if isinstance(label_masks, np.ndarray) and label_masks.ndim == 3:
+        for start in range(0, len(label_masks), batch_size):
+            yield label_masks[start:start + batch_size]
+        return
+    batch = []
+    for labels in label_masks:
+        labels = np.asarray(labels)
+        if batch and (len(batch) == batch_size or labels.shape != batch[0].shape):
+            yield np.stack(batch)
+            batch = []
+        batch.append(labels)
+    if batch:
+        yield np.stack(batch)
+
+def _measure_batch(labels, offset=None):
+    """
+    Measures an (N, H, W) label stack. With ``offset`` (y, x) the stack is a crop at that
+    position in the full image: results are in full-image coordinates and identical to
+    measuring the uncropped frames, as long as the crop holds every labelled pixel.
+    """
+    n, h, w = labels.shape
+    out = np.zeros(n, dtype=MEASURE_DTYPE)
+    for name in MEASURE_FIELDS:
+        out[name] = np.nan
+    if labels.size == 0:
+        return out
+    oy, ox = (0, 0) if offset is None else (int(offset[0]), int(offset[1]))
+    masks_ao, masks_pa, masks_tra = split_label_mask(labels)
+    margin = setting('ROI_MARGIN')
+    bboxes_ao = stack_bboxes(masks_ao, margin)
+    bboxes_pa = stack_bboxes(masks_pa, margin)
+    tra_rows = masks_tra.sum(axis=2)
+    tra_count = tra_rows.sum(axis=1)
+    centers_tra = np.column_stack([tra_rows @ np.arange(oy, oy + h), masks_tra.sum(axis=1) @ np.arange(ox, ox + w)])
+    centers_tra = centers_tra / np.maximum(tra_count, 1)[:, None]
+
+    frames, anchors_ao, normals_ao, anchors_pa, normals_pa = [], [], [], [], []
+    for i in np.flatnonzero((tra_count > 0) & (bboxes_ao[:, 0] >= 0) & (bboxes_pa[:, 0] >= 0)):
+        with timing.stage("centerline"):
+            line_ao = Centerline(get_centerline(masks_ao[i], bbox=bboxes_ao[i]) + (oy, ox))
+            line_pa = Centerline(get_centerline(masks_pa[i], bbox=bboxes_pa[i]) + (oy, ox))
+        if len(line_ao) == 0 or len(line_pa) == 0:
+            continue
+        P_a, min_idx = line_ao.nearest(centers_tra[i])
+        P_p, min_idx_pa = line_pa.nearest(P_a)
+        frames.append(i)
+        anchors_ao.append(P_a)
+        normals_ao.append(line_ao.normal(min_idx))
+        anchors_pa.append(P_p)
+        normals_pa.append(line_pa.normal(min_idx_pa))
+    if not frames:
+        return out
+
+    frames = np.array(frames)
+    out['valid'][frames] = True
+    for vessel, masks, anchors, normals in (('AO', masks_ao, anchors_ao, normals_ao),
+                                            ('PA', masks_pa, anchors_pa, normals_pa)):
+        with timing.stage("rays"):
+            diameters, p1, p2 = cast_rays(masks, np.array(anchors), np.array(normals), frames=frames,
+                                          offsets=None if offset is None else (oy, ox))
+        out[f'diameter_{vessel}'][frames] = diameters
+        out[f'{vessel}_point1_x'][frames], out[f'{vessel}_point1_y'][frames] = p1[:, 0], p1[:, 1]
+        out[f'{vessel}_point2_x'][frames], out[f'{vessel}_point2_y'][frames] = p2[:, 0], p2[:, 1]
+    return out
+
+def measure_many(label_masks, batch_size=32):
+    """Measure a (N, H, W) label stack, or any iterable of label masks, batch by batch.
+
+    Returns a structured array with MEASURE_DTYPE, one record per frame: NaN marks a
+    missing endpoint and ``valid`` is False where a structure was absent. Records hold
+    exactly what measure_label_mask returns for the same frame.
+    """
+    batches = [_measure_batch(batch) for batch in _label_batches(label_masks, batch_size)]
+    return np.concatenate(batches) if batches else np.zeros(0, dtype=MEASURE_DTYPE)
+
+def record_measurements(record):
+    # One measure_many record back in the (diam_ao, diam_pa, p1_ao, p2_ao, p1_pa, p2_pa) form
+    if not record['valid']:
+        return None, None, None, None, None, None
+    measurements = [record['diameter_AO'], record['diameter_PA']]
+    for vessel in ('AO', 'PA'):
+        for point in ('point1', 'point2'):
+            x, y = record[f'{vessel}_{point}_x'], record[f'{vessel}_{point}_y']
+            measurements.append(None if np.isnan(x) else (int(x), int(y)))
+    return tuple(measurements)
+
+def result_image_path(path):
+    return os.path.join(os.path.dirname(path), os.path.basename(path).split('.')[0] + '_result.png')
+
+def _draw_outlined_line(img_bgr, p1, p2, color):
+    # White halo keeps the line visible on top of the same-colored vessel mask
+    import cv2
+    p1, p2 = (int(p1[0]), int(p1[1])), (int(p2[0]), int(p2[1]))
+    cv2.line(img_bgr, p1, p2, (255, 255, 255), 4, cv2.LINE_AA)
+    cv2.line(img_bgr, p1, p2, color, 2, cv2.LINE_AA)
+
+def render_overlay(img_bgr, title, center_tra, p1_ao, p2_ao, p1_pa, p2_pa):
+    # Draws straight onto the (BGR) image array; no pyplot state is involved.
+    import cv2
+    legend = [("TRA center", (255, 0, 0))]
+    center = (int(round(center_tra[1])), int(round(center_tra[0])))
+    cv2.drawMarker(img_bgr, center, (255, 255, 255), cv2.MARKER_TILTED_CROSS, 14, 4)
+    cv2.drawMarker(img_bgr, center, (255, 0, 0), cv2.MARKER_TILTED_CROSS, 12, 2)
+    if p1_ao and p2_ao:
+        _draw_outlined_line(img_bgr, p1_ao, p2_ao, (0, 0, 255))
+        legend.append(("AO diameter", (0, 0, 255)))
+    if p1_pa and p2_pa:
+        _draw_outlined_line(img_bgr, p1_pa, p2_pa, (0, 255, 0))
+        legend.append(("PA diameter", (0, 255, 0)))
+    cv2.putText(img_bgr, title, (10, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+    for i, (label, color) in enumerate(legend):
+        cv2.putText(img_bgr, label, (10, 40 + 18 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.45, color, 1, cv2.LINE_AA)
+    return img_bgr
+
+def save_overlay(path, img_bgr, center_tra, p1_ao, p2_ao, p1_pa, p2_pa):
+    import cv2
+    overlay = render_overlay(img_bgr, os.path.basename(path), center_tra, p1_ao, p2_ao, p1_pa, p2_pa)
+    ok, encoded = cv2.imencode('.png', overlay)
+    if not ok:
+        raise IOError(f"could not encode {result_image_path(path)}")
+    # Written to a temporary name and renamed, so a half-written overlay is never visible
+    out_path = result_image_path(path)
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(encoded.tobytes())
+    os.replace(tmp_path, out_path)
+
+class OverlayRenderer:
+    """Renders ``_result.png`` overlays on a background thread pool.
+
+    OpenCV drawing and PNG encoding release the GIL, so measurement keeps running
+    while overlays are written; at most ``max_pending`` frames are queued at once.
+    """
+
+    def __init__(self, workers=2, max_pending=16):
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, path, img_bgr, center_tra, p1_ao, p2_ao, p1_pa, p2_pa):
+        self._slots.acquire()
+        future = self._pool.submit(save_overlay, path, img_bgr, center_tra, p1_ao, p2_ao, p1_pa, p2_pa)
+        future.add_done_callback(lambda f: self._done(path, f))
+
+    def _done(self, path, future):
+        self._slots.release()
+        if future.exception() is not None:
+            print(f"Rendering {os.path.basename(path)} failed: {future.exception()}")
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+def process_image(path, visualize=False, renderer=None):
+    # Stages (read, decode, centerline, rays, overlay) are timed when timing is enabled, see timing.py
+    import cv2
+    with timing.stage("read"):
+        img = cv2.imread(path)
     if img is None:
         print(f"Reading Files Error: {path}")
         return None, None, None, None, None, None
-    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    mask_ao = get_mask_from_rgb(img_rgb, [255, 0, 0])
-    mask_pa = get_mask_from_rgb(img_rgb, [0, 255, 0])
-    mask_tra = get_mask_from_rgb(img_rgb, [0, 0, 255])
-    pts_ao = get_centerline(mask_ao)
-    pts_pa = get_centerline(mask_pa)
-    pts_tra = np.column_stack(np.nonzero(mask_tra))
-    if pts_ao.size == 0 or pts_pa.size == 0 or pts_tra.size == 0:
-        return None, None, None, None, None, None
-    center_tra = np.mean(pts_tra, axis=0)
-    dists = cdist(pts_ao, center_tra[None])
-    min_idx = np.argmin(dists)
-    P_a = pts_ao[min_idx]
-    normal_ao = compute_normal(pts_ao, min_idx)
-    diam_ao, p1_ao, p2_ao = measure_diameter(mask_ao, P_a, normal_ao)
-    dists_pa = cdist(pts_pa, P_a[None])
-    min_idx_pa = np.argmin(dists_pa)
-    P_p = pts_pa[min_idx_pa]
-    normal_pa = compute_normal(pts_pa, min_idx_pa)
-    diam_pa, p1_pa, p2_pa = measure_diameter(mask_pa, P_p, normal_pa)
+    with timing.stage("decode"):
+        masks = split_label_mask(decode_color_mask(img, bgr=True))
+    measurements, center_tra = _measure_masks(*masks)
+    if center_tra is None:
+        return measurements
+    diam_ao, diam_pa, p1_ao, p2_ao, p1_pa, p2_pa = measurements
     if visualize:
-        plt.imshow(img_rgb)
-        plt.scatter(center_tra[1], center_tra[0], c='blue', marker='x', label='TRA center')
-        if p1_ao and p2_ao:
-            plt.plot([p1_ao[0], p2_ao[0]], [p1_ao[1], p2_ao[1]], 'r-', label='AO diameter')
-        if p1_pa and p2_pa:
-            plt.plot([p1_pa[0], p2_pa[0]], [p1_pa[1], p2_pa[1]], 'g-', label='PA diameter')
-        plt.title(os.path.basename(path))
-        plt.legend()
-        plt.savefig(os.path.join(os.path.dirname(path), os.path.basename(path).split('.')[0] + '_result.png'))
+        with timing.stage("overlay"):
+            if renderer is None:
+                save_overlay(path, img, center_tra, p1_ao, p2_ao, p1_pa, p2_pa)
+            else:
+                renderer.submit(path, img, center_tra, p1_ao, p2_ao, p1_pa, p2_pa)
     return diam_ao, diam_pa, p1_ao, p2_ao, p1_pa, p2_pa
 
-def process_folder(folder_path, visualize=False, output_csv=OUTPUT_CSV, output_json=OUTPUT_JSON):
-    print("Folder:", folder_path)
-    results = []
-    for filename in os.listdir(folder_path):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            file_path = os.path.join(folder_path, filename)
-            try:
-                diam_ao, diam_pa, p1_ao, p2_ao, p1_pa, p2_pa = process_image(file_path, visualize)
-                result = {
-                    'filename': filename,
-                    'diameter_AO': float(f"{diam_ao:.2f}"),
-                    'AO_point1_x': p1_ao[0] if p1_ao else '',
-                    'AO_point1_y': p1_ao[1] if p1_ao else '',
-                    'AO_point2_x': p2_ao[0] if p2_ao else '',
-                    'AO_point2_y': p2_ao[1] if p2_ao else '',
-                    'diameter_PA': float(f"{diam_pa:.2f}"),
-                    'PA_point1_x': p1_pa[0] if p1_pa else '',
-                    'PA_point1_y': p1_pa[1] if p1_pa else '',
-                    'PA_point2_x': p2_pa[0] if p2_pa else '',
-                    'PA_point2_y': p2_pa[1] if p2_pa else '',
-                }
-                results.append(result)
-                print(f"{filename} --> AO diameter: {diam_ao:.2f}, PA diameter: {diam_pa:.2f}")
-            except Exception as e:
-                print(f"Processing {filename} failed: {e}")
-    if results:
-        with open(output_csv, 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=results[0].keys())
-            writer.writeheader()
-            writer.writerows(results)
-        print(f"Saving CSVs to {output_csv}")
-    with open(output_json, 'w') as jsonfile:
-        json.dump(results, jsonfile, indent=4)
-    print(f"Saving JSON to {output_json}")
-
-def main():
-    os.chdir(WORK_DIR)
-    process_folder(INPUT_FOLDER, visualize=VISUALIZE)
+def is_result_image(filename):
+    # Overlays written next to the predictions by save_overlay
+    return os.path.splitext(filename)[0].endswith('_result')
+
+def list_images(folder_path):
+    return sorted(f for f in os.listdir(folder_path)
+                  if f.lower().endswith(('.png', '.jpg', '.jpeg')) and not is_result_image(f))
+
+def result_row(filename, measurements):
+    diam_ao, diam_pa, p1_ao, p2_ao, p1_pa, p2_pa = measurements
+    return {
+        'filename': filename,
+        'diameter_AO': float(f"{diam_ao:.2f}"),
+        'AO_point1_x': p1_ao[0] if p1_ao else '',
+        'AO_point1_y': p1_ao[1] if p1_ao else '',
+        'AO_point2_x': p2_ao[0] if p2_ao else '',
+        'AO_point2_y': p2_ao[1] if p2_ao else '',
+        'diameter_PA': float(f"{diam_pa:.2f}"),
+        'PA_point1_x': p1_pa[0] if p1_pa else '',
+        'PA_point1_y': p1_pa[1] if p1_pa else '',
+        'PA_point2_x': p2_pa[0] if p2_pa else '',
+        'PA_point2_y': p2_pa[1] if p2_pa else '',
+    }
+
+def _measure_file(folder_path, filename, visualize=False, renderer=None):
+    try:
+        row = result_row(filename, process_image(os.path.join(folder_path, filename), visualize, renderer))
+        return row, f"{filename} --> AO diameter: {row['diameter_AO']:.2f}, PA diameter: {row['diameter_PA']:.2f}"
+    except Exception as e:
+        return None, f"Processing {filename} failed: {e}"
+
+def _timed(fn, *args):
+    # (fn's result, its stage timings); timings is None unless timing is enabled
+    if not timing.enabled():
+        return fn(*args), None
+    with timing.record() as records:
+        result = fn(*args)
+    return result, records
+
+def measure_file(folder_path, filename, visualize=False, renderer=None):
+    """
+    Returns ((row, log line), stage timings); row is None when the image failed, so one
+    bad file never takes down the whole folder (or a worker process). The timings (None
+    when timing is off) let the parent add a worker's stages to its own totals.
+    """
+    return _timed(_measure_file, folder_path, filename, visualize, renderer)
+
+def _merge_timings(results):
+    # Pool results: fold each worker call's stage timings into this process's totals
+    for result, records in results:
+        if records:
+            timing.merge(records)
+        yield result
+
+def _measure_serially(folder_path, filenames, visualize):
+    # Serial runs hand overlays to a background renderer; pool workers render
+    # in-process, since they already run in parallel.
+    renderer = OverlayRenderer() if visualize else None
+    try:
+        for filename in filenames:
+            yield _measure_file(folder_path, filename, visualize, renderer)
+    finally:
+        if renderer is not None:
+            renderer.close()
+
+def _own_pool_map(workers, fn, *iterables, chunksize=1):
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(fn, *iterables, chunksize=chunksize)
+
+def _pool_map(pool, workers, fn, *iterables, chunksize=1):
+    # map() yields in submission order, so output order never depends on scheduling.
+    # On a shared pool it also submits every task up front, letting several folders
+    # queue their work before any of them is consumed.
+    if pool is not None:
+        return pool.map(fn, *iterables, chunksize=chunksize)
+    return _own_pool_map(workers, fn, *iterables, chunksize=chunksize)
+
+def _chain(parts):
+    for part in parts:
+        yield from part
+
+def iter_measurements(folder_path, filenames, visualize=False, workers=1, pool=None):
+    if pool is None and workers <= 1:
+        return _measure_serially(folder_path, filenames, visualize)
+    chunksize = max(1, len(filenames) // (workers * 4))
+    results = _pool_map(pool, workers, measure_file, repeat(folder_path), filenames, repeat(visualize),
+                        chunksize=chunksize)
+    return _merge_timings(results)
+
+def packed_index_path(pack_path):
+    return os.path.splitext(pack_path)[0] + '.index.json'
+
+def is_packed(path):
+    return os.path.isfile(path) and path.lower().endswith('.npy')
+
+def pack_predictions(folder_path, pack_path):
+    """Pack a folder of color prediction masks into one memory-mappable label file.
+
+    ``pack_path`` is a flat uint8 .npy buffer holding, back to back, each frame's label
+    mask cropped to the bounding box of its labelled pixels. The sidecar index holds
+    each frame's filename, original shape, crop box (y0, y1, x0, x1), byte offset and
+    the SHA-1 of its source file, so resumable runs share the folder run's manifest keys.
+    """
+    import cv2
+    header = {'descr': '|u1', 'fortran_order': False, 'shape': (0,)}
+    filenames, shapes, bboxes, offsets, digests = [], [], [], [], []
+    with open(pack_path, 'wb') as f:
+        # The header is rewritten with the final length; numpy pads it so its size does not change
+        np.lib.format.write_array_header_1_0(f, header)
+        data_start = f.tell()
+        for filename in list_images(folder_path):
+            with open(os.path.join(folder_path, filename), 'rb') as src:
+                data = src.read()
+            img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                print(f"Reading Files Error: {os.path.join(folder_path, filename)}")
+                continue
+            labels = decode_color_mask(img, bgr=True)
+            bbox = mask_bbox(labels > 0) or (0, 0, 0, 0)
+            y0, y1, x0, x1 = (int(v) for v in bbox)
+            filenames.append(filename)
+            shapes.append(labels.shape)
+            bboxes.append((y0, y1, x0, x1))
+            offsets.append(f.tell() - data_start)
+            digests.append(hashlib.sha1(data).hexdigest())
+            f.write(np.ascontiguousarray(labels[y0:y1, x0:x1]).tobytes())
+        header['shape'] = (f.tell() - data_start,)
+        f.seek(0)
+        np.lib.format.write_array_header_1_0(f, header)
+        assert f.tell() == data_start
+    with open(packed_index_path(pack_path), 'w', encoding='utf-8') as f:
+        json.dump({'filenames': filenames, 'shapes': shapes, 'bboxes': bboxes, 'offsets': offsets,
+                   'sha1': digests}, f)
+    print(f"Packed {len(filenames)} masks from {folder_path} into {pack_path}")
+
+def open_packed(pack_path):
+    # Memory-mapped read-only buffer; frames are viewed from it without copying
+    with open(packed_index_path(pack_path), 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    return np.load(pack_path, mmap_mode='r'), index
+
+def packed_frame(buffer, index, i):
+    """Frame ``i`` of a pack as (crop view, (y0, x0) position of the crop in the image)."""
+    y0, y1, x0, x1 = index['bboxes'][i]
+    start = index['offsets'][i]
+    crop = buffer[start:start + (y1 - y0) * (x1 - x0)].reshape(y1 - y0, x1 - x0)
+    return crop, (y0, x0)
+
+def measure_packed(pack_path, positions):
+    """((row, log line) per position, stage timings of the chunk); timings are None when timing is off."""
+    return _timed(_measure_packed, pack_path, positions)
+
+def _measure_packed(pack_path, positions):
+    buffer, index = open_packed(pack_path)
+    outcomes = []
+    for i in positions:
+        filename = index['filenames'][i]
+        try:
+            crop, offset = packed_frame(buffer, index, i)
+            row = result_row(filename, record_measurements(_measure_batch(crop[None], offset)[0]))
+            outcomes.append((row, f"{filename} --> AO diameter: {row['diameter_AO']:.2f}, "
+                                  f"PA diameter: {row['diameter_PA']:.2f}"))
+        except Exception as e:
+            outcomes.append((None, f"Processing {filename} failed: {e}"))
+    return outcomes
+
+def iter_packed_measurements(pack_path, filenames, workers=1, pool=None, chunk=64):
+    _, index = open_packed(pack_path)
+    position = {filename: i for i, filename in enumerate(index['filenames'])}
+    positions = [position[filename] for filename in filenames]
+    chunks = [positions[start:start + chunk] for start in range(0, len(positions), chunk)]
+    if pool is None and workers <= 1:
+        return _chain(_measure_packed(pack_path, part) for part in chunks)
+    # Workers map the same file themselves; only chunk positions cross process boundaries
+    return _chain(_merge_timings(_pool_map(pool, workers, measure_packed, repeat(pack_path), chunks)))
+
+def measurement_params():
+    # Anything that changes a result row must be listed here, so cached rows are
+    # invalidated when it changes.
+    return {
+        'version': MEASUREMENT_VERSION,
+        'diameter_search_length': setting('DIAM_LEN'),
+        'roi_margin': setting('ROI_MARGIN'),
+        'tangent_window': setting('TANGENT_WINDOW'),
+    }
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def manifest_path_for(output_csv):
+    return os.path.splitext(output_csv)[0] + '.manifest.jsonl'
+
+class MeasurementManifest:
+    """Append-only JSON Lines record of measured files, keyed by content hash.
+
+    Every finished image is appended and flushed immediately, so an interrupted run
+    can be resumed; entries measured with different parameters are ignored.
+    """
+
+    def __init__(self, path, params):
+        self.path = path
+        self.params = params
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn last line from an interrupted run
+                    if entry.get('params') == params:
+                        self.entries[entry['filename']] = entry
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def lookup(self, filename, digest):
+        entry = self.entries.get(filename)
+        if entry is not None and entry['sha1'] == digest:
+            return entry['row'], entry['message']
+        return None
+
+    def record(self, filename, digest, row, message):
+        entry = {'filename': filename, 'sha1': digest, 'params': self.params, 'row': row, 'message': message}
+        self.entries[filename] = entry
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+
+    def close(self, keep):
+        # Compact to the files that still exist so the manifest does not grow across runs
+        self._file.close()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for filename in keep:
+                if filename in self.entries:
+                    f.write(json.dumps(self.entries[filename]) + '\n')
+        os.replace(tmp_path, self.path)
+
+class ResultWriter:
+    """Streams result rows to ``output_csv`` and a JSON Lines twin of ``output_json``.
+
+    Rows hit disk as they arrive (flushed every ``flush_every`` rows), so a crash keeps
+    everything measured so far; ``finalize`` then writes the legacy indented JSON array.
+    """
+
+    def __init__(self, output_csv, output_json, flush_every=100):
+        self.output_csv = output_csv
+        self.output_json = output_json
+        self.output_jsonl = jsonl_path_for(output_json)
+        self.flush_every = flush_every
+        self.count = 0
+        self._csv_file = None
+        self._csv_writer = None
+        self._jsonl_file = open(self.output_jsonl, 'w', encoding='utf-8')
+
+    def write(self, row):
+        if self._csv_writer is None:
+            # Like the batch writer, only create the CSV once there is a row to put in it
+            self._csv_file = open(self.output_csv, 'w', newline='')
+            self._csv_writer = csv.DictWriter(self._csv_file, fieldnames=row.keys())
+            self._csv_writer.writeheader()
+        self._csv_writer.writerow(row)
+        self._jsonl_file.write(json.dumps(row) + '\n')
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        if self._csv_file is not None:
+            self._csv_file.flush()
+        self._jsonl_file.flush()
+
+    def close(self):
+        if self._csv_file is not None:
+            self._csv_file.close()
+        self._jsonl_file.close()
+
+    def finalize(self):
+        self.close()
+        if self.count:
+            print(f"Saving CSVs to {self.output_csv}")
+        # Same bytes as json.dump(rows, f, indent=4), without holding the rows in memory
+        with open(self.output_jsonl, 'r', encoding='utf-8') as src, open(self.output_json, 'w') as dst:
+            dst.write('[')
+            for i, line in enumerate(src):
+                dst.write('\n' if i == 0 else ',\n')
+                dst.write(textwrap.indent(json.dumps(json.loads(line), indent=4), '    '))
+            dst.write('\n]' if self.count else ']')
+        print(f"Saving JSON to {self.output_json}")
+
+def jsonl_path_for(output_json):
+    return os.path.splitext(output_json)[0] + '.jsonl'
+
+class MeasurementRun:
+    """One input folder (or packed stack) on its way to ``output_csv``.
+
+    Creating the run lists the inputs, consults the resume manifest and starts
+    measuring; ``write`` then streams the rows out in filename order. Starting several
+    runs on one shared pool before writing any of them keeps every worker busy.
+    """
+
+    def __init__(self, folder_path, output_csv, visualize=False, workers=1, resume=True, pool=None):
+        print("Folder:", folder_path)
+        self.output_csv = output_csv
+        packed = is_packed(folder_path)
+        if packed:
+            _, index = open_packed(folder_path)
+            self.filenames = index['filenames']
+            if visualize:
+                print("Visualization is not available for packed input; skipping overlays")
+        else:
+            self.filenames = list_images(folder_path)
+        self.cached = {}
+        self.manifest = None
+        pending = self.filenames
+        if resume:
+            self.manifest = MeasurementManifest(manifest_path_for(output_csv), measurement_params())
+            if packed:
+                self.digests = dict(zip(self.filenames, index['sha1']))
+            else:
+                self.digests = {filename: file_digest(os.path.join(folder_path, filename))
+                                for filename in self.filenames}
+            # Overlays are drawn while measuring, so with visualize on an image whose
+            # overlay is missing is measured again rather than reused
+            needs_overlay = visualize and not packed
+            pending = []
+            for filename in self.filenames:
+                entry = self.manifest.lookup(filename, self.digests[filename])
+                if entry is not None and needs_overlay and entry[0] is not None and \
+                        not os.path.exists(result_image_path(os.path.join(folder_path, filename))):
+                    entry = None
+                if entry is None:
+                    pending.append(filename)
+                else:
+                    self.cached[filename] = entry
+            print(f"Reusing {len(self.cached)} unchanged measurements, measuring {len(pending)} images")
+        if packed:
+            self.measured = iter_packed_measurements(folder_path, pending, workers, pool)
+        else:
+            self.measured = iter_measurements(folder_path, pending, visualize, workers, pool)
+
+    def rows(self):
+        """Yields the result rows in filename order, cached and fresh alike, recording fresh ones in the manifest."""
+        try:
+            # Merge cached and freshly measured rows back into filename order as they arrive
+            for filename in self.filenames:
+                if filename in self.cached:
+                    row, message = self.cached[filename]
+                else:
+                    row, message = next(self.measured)
+                    print(message)
+                    if self.manifest is not None:
+                        self.manifest.record(filename, self.digests[filename], row, message)
+                if row is not None:
+                    yield row
+        finally:
+            self.measured.close()
+            if self.manifest is not None:
+                self.manifest.close(self.filenames)
+
+    def write(self, output_json):
+        writer = ResultWriter(self.output_csv, output_json)
+        try:
+            for row in self.rows():
+                writer.write(row)
+        finally:
+            writer.close()
+        writer.finalize()
+
+def process_folder(folder_path, visualize=False, output_csv=None, output_json=None, workers=None,
+                   resume=None, pool=None):
+    # None falls back to output_csv / output_json / workers / resume in config.yaml
+    output_csv = setting('OUTPUT_CSV') if output_csv is None else output_csv
+    output_json = setting('OUTPUT_JSON') if output_json is None else output_json
+    workers = setting('WORKERS') if workers is None else workers
+    resume = setting('RESUME') if resume is None else resume
+    MeasurementRun(folder_path, output_csv, visualize, workers, resume, pool).write(output_json)
+
+def process_models(input_folders, output_csvs, visualize=False, workers=None, resume=None):
+    """Measure several models' prediction folders in one run, sharing one worker pool.
+
+    ``input_folders`` maps model name to prediction folder (or packed .npy) and
+    ``output_csvs`` maps model name to its CSV (``model_files`` in config.yaml); the
+    JSON output sits next to each CSV.
+    """
+    workers = setting('WORKERS') if workers is None else workers
+    resume = setting('RESUME') if resume is None else resume
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        runs = [(model, MeasurementRun(folder_path, output_csvs[model], visualize, workers, resume, pool))
+                for model, folder_path in input_folders.items()]
+        for model, run in runs:
+            print(f"--- Writing {model} results ---")
+            run.write(os.path.splitext(run.output_csv)[0] + '.json')
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+def measurement_targets():
+    """
+    Model name -> (prediction folder, output CSV) for this configuration: every
+    ``input_folders`` entry with its model_files CSV, or else ``input_folder`` with
+    ``output_csv`` under the model whose model_files CSV has the same name.
+    """
+    input_folders, model_files, output_csv = setting('INPUT_FOLDERS'), setting('MODEL_FILES'), setting('OUTPUT_CSV')
+    if input_folders:
+        return {model: (folder_path, model_files[model]) for model, folder_path in input_folders.items()}
+    csv_name = os.path.basename(output_csv)
+    model = next((model for model, path in model_files.items() if os.path.basename(path) == csv_name),
+                 os.path.splitext(csv_name)[0])
+    return {model: (setting('INPUT_FOLDER'), output_csv)}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure AO/PA diameters from color prediction masks.")
+    parser.add_argument("--workers", type=int, default=setting('WORKERS'),
+                        help="number of measurement processes (default: 'workers' in config.yaml)")
+    parser.add_argument("--no-resume", dest="resume", action="store_false", default=setting('RESUME'),
+                        help="re-measure every image instead of reusing unchanged results from the manifest")
+    parser.add_argument("--pack", metavar="OUTPUT_NPY",
+                        help="pack input_folder into a memory-mapped file of cropped label masks and exit; "
+                             "point input_folder at the .npy to measure from it")
+    parser.add_argument("--timing", action="store_true", default=timing.enabled(),
+                        help="print per-stage wall and CPU time totals at the end (also on with VESSELSEG_TIMING=1)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.chdir(setting('WORK_DIR'))
+    if args.pack:
+        pack_predictions(setting('INPUT_FOLDER'), args.pack)
+        return
+    if args.timing:
+        timing.enable()
+    input_folders, visualize = setting('INPUT_FOLDERS'), setting('VISUALIZE')
+    if input_folders:
+        process_models(input_folders, setting('MODEL_FILES'), visualize=visualize, workers=args.workers,
+                       resume=args.resume)
+    else:
+        process_folder(setting('INPUT_FOLDER'), visualize=visualize, workers=args.workers, resume=args.resume)
+    if args.timing:
+        # Worker processes' stages are merged in as their results arrive
+        print("\nStage timings:")
+        print(timing.format_totals())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
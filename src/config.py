@@ -0,0 +1,48 @@
+import os
+
+CONFIG_ENV = "VESSELSEG_CONFIG"
+
+_config_path = None
+_configs = {}
+
+def config_path():
+    """
+    The config.yaml in use: $VESSELSEG_CONFIG, else config.yaml in the working directory.
+    Resolved once, so a later os.chdir (biometric.main moves to work_dir) does not change it.
+    """
+    global _config_path
+    if _config_path is None:
+        use_config(os.environ.get(CONFIG_ENV, "config.yaml"))
+    return _config_path
+
+def use_config(path):
+    """Makes ``path`` the config for this process and for the worker processes it starts."""
+    global _config_path
+    _config_path = os.path.abspath(path)
+    os.environ[CONFIG_ENV] = _config_path
+
+def load_config(path=None):
+    """Parsed config file (``config_path()`` by default), read on first use and cached."""
+    path = os.path.abspath(path) if path else config_path()
+    if path not in _configs:
+        import yaml
+        with open(path, "r", encoding="utf-8") as f:
+            _configs[path] = yaml.safe_load(f) or {}
+    return _configs[path]
+
+def settings_accessors(module_name, table):
+    """
+    ``setting(name)`` and a module-level ``__getattr__`` for a table of config.yaml
+    settings, {NAME: function(config) -> value}. Values are read on first use, so
+    importing a module never loads the config; the ``__getattr__`` keeps the old module
+    constants (``biometric.WORKERS``, ...) working.
+    """
+    def setting(name):
+        return table[name](load_config())
+
+    def __getattr__(name):
+        if name in table:
+            return setting(name)
+        raise AttributeError(f"module {module_name!r} has no attribute {name!r}")
+
+    return setting, __getattr__
@@ -2,14 +2,37 @@ import json
 import os
 import math
 import csv
-import yaml
+import re
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 
-with open("config.yaml", "r", encoding="utf-8") as f:
-    cfg = yaml.safe_load(f)
+try:
+    from .config import settings_accessors
+except ImportError:  # run as a script from src/
+    from config import settings_accessors
 
-GROUPS_PATH = cfg["groups_path"]
-OUTPUT_DIR = cfg["output_dir"]
-MODEL_FILES = cfg["model_files"]
+_SETTINGS = {
+    'GROUPS_PATH': lambda cfg: cfg["groups_path"],
+    'OUTPUT_DIR': lambda cfg: cfg["output_dir"],
+    'MODEL_FILES': lambda cfg: cfg["model_files"],
+    'WORKERS': lambda cfg: cfg.get("workers", 1),
+    'DEVIATION_JSON': lambda cfg: cfg.get("deviation_json", False),
+    'GOLD_CACHE': lambda cfg: cfg.get("gold_cache") or os.path.join(cfg["output_dir"], "gold_standard_index.json"),
+}
+setting, __getattr__ = settings_accessors(__name__, _SETTINGS)
+
+GROUP_NAMES = ("group1", "group2", "group3")
+GOLD_VERSION = 2
+
+# Array layout shared by the columnar engine: vessel 0 is the aorta (the experts'
+# red line), vessel 1 the pulmonary artery (green); each line has two (x, y) endpoints.
+VESSELS = ("aorta", "pulmonary_artery")
+EXPERT_COLORS = ("red", "green")
+MODEL_PREFIXES = ("AO", "PA")
+EXPERT_PAIRS = ((1, 2), (1, 3), (2, 3))
+RATERS = ("model", "expert1", "expert2", "expert3")
 
 def load_json(path):
     with open(path, 'r', encoding='utf-8') as f:
@@ -19,21 +42,41 @@ def save_json(data, path):
     with open(path, 'w', encoding='utf-8') as f:
         json.dump(data, f, indent=4, ensure_ascii=False)
 
-def load_csv_measurements(path):
-    results = {}
+def _measurement_point(row, prefix):
+    x, y = row[f'{prefix}_x'], row[f'{prefix}_y']
+    if x in ('', None) or y in ('', None):
+        return None
+    return (float(x), float(y))
+
+def measurement_from_row(row):
+    """A biometric result row (CSV, JSON Lines or in memory) as evaluate's measurement dict."""
+    return {
+        'diameter_AO': float(row['diameter_AO']),
+        'diameter_PA': float(row['diameter_PA']),
+        'AO_point1': _measurement_point(row, 'AO_point1'),
+        'AO_point2': _measurement_point(row, 'AO_point2'),
+        'PA_point1': _measurement_point(row, 'PA_point1'),
+        'PA_point2': _measurement_point(row, 'PA_point2'),
+    }
+
+def iter_rows(path):
+    """Lazily yields the raw result rows of a biometric CSV or streamed JSON Lines file."""
     with open(path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            filename = row['filename']
-            results[filename] = {
-                'diameter_AO': float(row['diameter_AO']),
-                'diameter_PA': float(row['diameter_PA']),
-                'AO_point1': (float(row['AO_point1_x']), float(row['AO_point1_y'])) if row['AO_point1_x'] and row['AO_point1_y'] else None,
-                'AO_point2': (float(row['AO_point2_x']), float(row['AO_point2_y'])) if row['AO_point2_x'] and row['AO_point2_y'] else None,
-                'PA_point1': (float(row['PA_point1_x']), float(row['PA_point1_y'])) if row['PA_point1_x'] and row['PA_point1_y'] else None,
-                'PA_point2': (float(row['PA_point2_x']), float(row['PA_point2_y'])) if row['PA_point2_x'] and row['PA_point2_y'] else None,
-            }
-    return results
+        if path.endswith('.jsonl'):
+            yield from (json.loads(line) for line in f if line.strip())
+        else:
+            yield from csv.DictReader(f)
+
+def iter_measurements(path):
+    """
+    Lazily yields (filename, measurement) pairs from a biometric CSV or from the
+    streamed JSON Lines file, one row at a time.
+    """
+    for row in iter_rows(path):
+        yield row['filename'], measurement_from_row(row)
+
+def load_csv_measurements(path):
+    return dict(iter_measurements(path))
 
 def euclidean_distance(p1, p2):
     return math.sqrt((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
@@ -74,79 +117,313 @@ def calculate_expert_errors(experts_data):
 
     return errors
 
-def process_one_model(meas_path, model_name, groups, output_dir):
+def canonical_image_key(name):
+    # "dir/946_0000.png", "946.png" and "946" all name the same image: nnUNet adds a
+    # _0000 channel suffix to inputs but not to predictions.
+    stem = os.path.splitext(os.path.basename(name))[0]
+    return re.sub(r'_\d{4}$', '', stem)
+
+def compile_gold_standard(groups):
+    """
+    Index the expert annotations by image: {image_key: {"expertN_red": [[x, y], [x, y]],
+    "expertN_green": ...}}. Later annotations of the same colour win, as before.
+    """
+    experts_by_image = {}
+    for i, group_key in enumerate(GROUP_NAMES, start=1):
+        for item in groups[group_key]["items"]:
+            if not (isinstance(item, dict) and 'id' in item):
+                continue
+            experts_data = experts_by_image.setdefault(canonical_image_key(item['id']), {})
+            for annotation in item['annotations']:
+                pts = annotation['points']
+                if len(pts) < 4:
+                    continue
+                if annotation['label_id'] == 0:
+                    experts_data[f"expert{i}_green"] = [[pts[0], pts[1]], [pts[2], pts[3]]]
+                elif annotation['label_id'] == 1:
+                    experts_data[f"expert{i}_red"] = [[pts[0], pts[1]], [pts[2], pts[3]]]
+    return experts_by_image
+
+def _group_sources(groups_path):
+    sources = {}
+    for group_key in GROUP_NAMES:
+        path = os.path.abspath(os.path.join(groups_path, f"{group_key}.json"))
+        stat = os.stat(path)
+        sources[group_key] = [path, stat.st_mtime_ns, stat.st_size]
+    return sources
+
+def load_gold_standard(groups_path=None, cache_path=None):
+    """
+    Returns the compiled gold standard, rebuilding the on-disk cache whenever a
+    groupN.json file has changed (path, modification time or size). Paths default
+    to groups_path and gold_cache in config.yaml.
+    """
+    groups_path = setting('GROUPS_PATH') if groups_path is None else groups_path
+    cache_path = setting('GOLD_CACHE') if cache_path is None else cache_path
+    sources = _group_sources(groups_path)
+    if cache_path and os.path.exists(cache_path):
+        cached = load_json(cache_path)
+        if cached.get('version') == GOLD_VERSION and cached.get('sources') == sources:
+            return cached['images']
+    groups = {group_key: load_json(sources[group_key][0]) for group_key in GROUP_NAMES}
+    images = compile_gold_standard(groups)
+    if cache_path:
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': GOLD_VERSION, 'sources': sources, 'images': images}, f, ensure_ascii=False)
+        print(f"Gold standard compiled to {cache_path}")
+    return images
+
+def lookup_gold_standard(gold, image_name):
+    # An exact key wins over substring matches: "1.png" now gets the annotations of
+    # "1_0000.png" only, where the old scan also merged in "11_0000.png" and the like.
+    image_key = canonical_image_key(image_name)
+    experts_data = gold.get(image_key)
+    if experts_data is not None:
+        return experts_data
+    # Fall back to the old substring match for names that do not normalize to the same key
+    experts_data = {}
+    for expert_image_key, candidate in gold.items():
+        if expert_image_key in image_key or image_key in expert_image_key:
+            experts_data.update(candidate)
+    return experts_data
+
+def metric_names():
+    """
+    Column order of the error table; it is also the key order of each image's entry
+    in the deviation JSON.
+    """
+    names = []
+    for i in range(1, 4):
+        for vessel in reversed(VESSELS):
+            names += [f"meas2expert{i}_length_{vessel}", f"meas2expert{i}_point_{vessel}"]
+    for a, b in EXPERT_PAIRS:
+        for vessel in VESSELS:
+            names += [f"expert{a}vs{b}_length_{vessel}", f"expert{a}vs{b}_point_{vessel}"]
+    return names
+
+METRIC_NAMES = metric_names()
+
+_EXPERT_SLOTS = [f"expert{i}_{color}" for i in range(1, 4) for color in EXPERT_COLORS]
+_MISSING_LINE = [[math.nan, math.nan], [math.nan, math.nan]]
+
+def expert_points_array(experts_list):
+    """(n, 3 experts, 2 vessels, 2 endpoints, xy) endpoints, NaN where an expert did not draw the line."""
+    flat = [
+        coord
+        for experts_data in experts_list
+        for slot in _EXPERT_SLOTS
+        for point in experts_data.get(slot, _MISSING_LINE)
+        for coord in point
+    ]
+    return np.array(flat, dtype=np.float64).reshape(-1, 3, 2, 2, 2)
+
+class GoldStandard:
+    """
+    The compiled expert annotations stacked into one (images, 3, 2, 2, 2) array, so that
+    aligning a model's images is a dict lookup plus a single take. Built once and shared
+    by every model being evaluated.
+    """
+
+    def __init__(self, experts_by_image):
+        self.experts_by_image = experts_by_image
+        self.index = {key: row for row, key in enumerate(experts_by_image)}
+        self.points = expert_points_array(experts_by_image.values())
+
+    def __len__(self):
+        return len(self.index)
+
+    def align(self, image_names):
+        """Expert endpoints for each image as (n, 3, 2, 2, 2); unmatched names use the substring fallback."""
+        rows = np.array([self.index.get(canonical_image_key(name), -1) for name in image_names], dtype=np.intp)
+        points = np.full((len(image_names), 3, 2, 2, 2), np.nan)
+        found = rows >= 0
+        points[found] = self.points[rows[found]]
+        missing = np.flatnonzero(~found)
+        points[missing] = expert_points_array(
+            [lookup_gold_standard(self.experts_by_image, image_names[n]) for n in missing])
+        return points
+
+def measurement_arrays(meas_data):
+    """
+    Model diameters as (n, 2) and endpoints as (n, 2 vessels, 2 endpoints, xy), with NaN
+    for the endpoints the biometric step could not find.
+    """
+    diameters = np.empty((len(meas_data), 2))
+    points = np.full((len(meas_data), 2, 2, 2), np.nan)
+    for n, meas in enumerate(meas_data.values()):
+        for v, prefix in enumerate(MODEL_PREFIXES):
+            diameters[n, v] = meas[f"diameter_{prefix}"]
+            p1, p2 = meas[f"{prefix}_point1"], meas[f"{prefix}_point2"]
+            if p1 is not None and p2 is not None:
+                points[n, v] = (p1, p2)
+    return diameters, points
+
+def _distance(p, q):
+    return np.sqrt((p[..., 0] - q[..., 0]) ** 2 + (p[..., 1] - q[..., 1]) ** 2)
+
+def compute_error_table(diameters, model_points, expert_points):
+    """
+    All per-image errors as one (n, len(METRIC_NAMES)) float64 table; NaN marks
+    errors that cannot be computed because a line is missing. Each value is computed
+    with the same operations, in the same order, as the scalar helpers above, except
+    that squares are exact ``x * x`` here while the helpers' float ``** 2`` goes through
+    libm pow: with non-integer coordinates a value can differ in the last bit.
+    """
+    expert_lengths = _distance(expert_points[..., 0, :], expert_points[..., 1, :])   # (n, 3, 2)
+    gt, pred = expert_points, model_points[:, None]
+    direct = _distance(gt[..., 0, :], pred[..., 0, :]) + _distance(gt[..., 1, :], pred[..., 1, :])
+    swapped = _distance(gt[..., 0, :], pred[..., 1, :]) + _distance(gt[..., 1, :], pred[..., 0, :])
+    point_errors = np.minimum(direct, swapped)
+    length_errors = np.abs(diameters[:, None] - expert_lengths)
+
+    columns = []
+    for i in range(3):
+        for v in reversed(range(len(VESSELS))):
+            columns += [length_errors[:, i, v], point_errors[:, i, v]]
+    for a, b in EXPERT_PAIRS:
+        pa, pb = expert_points[:, a - 1], expert_points[:, b - 1]
+        pair_points = _distance(pa[..., 0, :], pb[..., 0, :]) + _distance(pa[..., 1, :], pb[..., 1, :])
+        pair_lengths = np.abs(expert_lengths[:, a - 1] - expert_lengths[:, b - 1])
+        for v in range(len(VESSELS)):
+            columns += [pair_lengths[:, v], pair_points[:, v]]
+    return np.stack(columns, axis=1) if len(diameters) else np.empty((0, len(METRIC_NAMES)))
+
+def rater_lengths(diameters, expert_points):
+    """
+    (n, 4 raters, 2 vessels) diameters as measured by the model and by each expert, for
+    the agreement statistics; NaN where an expert did not draw the line or the model
+    found no diameter (0).
+    """
+    model = np.where(diameters > 0, diameters, np.nan)[:, None]
+    experts = _distance(expert_points[..., 0, :], expert_points[..., 1, :])
+    return np.concatenate([model, experts], axis=1)
+
+def error_records(image_names, table):
+    """Turns the error table back into the {image: {metric: value}} deviation dict."""
+    records = {}
+    for image_name, row in zip(image_names, table.tolist()):
+        records[image_name] = {name: value for name, value in zip(METRIC_NAMES, row) if value == value}
+    return records
+
+def deviation_path(output_dir, model_name, ext=".npz"):
+    return os.path.join(output_dir, f"deviation_3VV_from_csv_{model_name}{ext}")
+
+def save_deviation_table(path, image_names, table, lengths=None, metrics=METRIC_NAMES):
+    """
+    Stores the error table as an uncompressed NPZ: 'errors' is (images, metrics) float32
+    with NaN for missing errors, 'images' and 'metrics' name its rows and columns.
+    'lengths' (images, RATERS, VESSELS) holds the diameters behind them, for the
+    agreement statistics in summary.py.
+    """
+    arrays = {}
+    if lengths is not None:
+        arrays = {'lengths': np.asarray(lengths, dtype=np.float32),
+                  'raters': np.array(RATERS, dtype=str), 'vessels': np.array(VESSELS, dtype=str)}
+    with open(path, 'wb') as f:
+        np.savez(f, images=np.array(image_names, dtype=str), metrics=np.array(metrics, dtype=str),
+                 errors=np.asarray(table, dtype=np.float32), **arrays)
+
+def load_deviation_table(path):
+    """(images, metrics, errors) from a table written by save_deviation_table."""
+    with np.load(path) as data:
+        return data['images'].tolist(), data['metrics'].tolist(), data['errors']
+
+def evaluate_measurements(meas_data, gold):
+    image_names = list(meas_data)
+    diameters, model_points = measurement_arrays(meas_data)
+    expert_points = gold.align(image_names)
+    table = compute_error_table(diameters, model_points, expert_points)
+    return image_names, table, rater_lengths(diameters, expert_points)
+
+def iter_evaluated_batches(rows, gold, batch_size=1024):
+    """
+    Evaluates a stream of biometric result rows as it arrives, yielding
+    (image_names, error table, rater lengths) for every ``batch_size`` rows.
+    """
+    batch = {}
+    for row in rows:
+        batch[row['filename']] = measurement_from_row(row)
+        if len(batch) == batch_size:
+            yield evaluate_measurements(batch, gold)
+            batch = {}
+    if batch:
+        yield evaluate_measurements(batch, gold)
+
+def process_one_model(meas_path, model_name, gold, output_dir, write_json=None):
+    write_json = setting('DEVIATION_JSON') if write_json is None else write_json
     meas_data = load_csv_measurements(meas_path)
-    all_errors = {}
-
-    for image_name in meas_data:
-        try:
-            image_key = os.path.splitext(image_name)[0]
-            results = {}
-
-            diameter_ao = meas_data[image_name]['diameter_AO']
-            diameter_pa = meas_data[image_name]['diameter_PA']
-            ao_model_pts = [meas_data[image_name]['AO_point1'], meas_data[image_name]['AO_point2']]
-            pa_model_pts = [meas_data[image_name]['PA_point1'], meas_data[image_name]['PA_point2']]
-
-            experts_data = {}
-
-            for i in range(1, 4):
-                group_key = f"group{i}"
-                red_points = None
-                green_points = None
-
-                for item in groups[group_key]["items"]:
-                    if isinstance(item, dict) and 'id' in item:
-                        expert_image_key = os.path.basename(item['id']).split('/')[-1]
-                        if expert_image_key in image_key or image_key in expert_image_key:
-                            for annotation in item['annotations']:
-                                if annotation['label_id'] == 0:
-                                    pts = annotation['points']
-                                    if len(pts) >= 4:
-                                        green_points = [[pts[0], pts[1]], [pts[2], pts[3]]]
-                                elif annotation['label_id'] == 1:
-                                    pts = annotation['points']
-                                    if len(pts) >= 4:
-                                        red_points = [[pts[0], pts[1]], [pts[2], pts[3]]]
-
-                if green_points:
-                    experts_data[f"expert{i}_green"] = green_points
-                if red_points:
-                    experts_data[f"expert{i}_red"] = red_points
-
-            for i in range(1, 4):
-                if f"expert{i}_green" in experts_data:
-                    gt_len_pa = euclidean_distance(*experts_data[f"expert{i}_green"])
-                    results[f"meas2expert{i}_length_pulmonary_artery"] = abs(diameter_pa - gt_len_pa)
-                    if pa_model_pts[0] and pa_model_pts[1]:
-                        pt_err_pa = pointwise_distance_error(experts_data[f"expert{i}_green"], pa_model_pts)
-                        results[f"meas2expert{i}_point_pulmonary_artery"] = pt_err_pa
-
-                if f"expert{i}_red" in experts_data:
-                    gt_len_ao = euclidean_distance(*experts_data[f"expert{i}_red"])
-                    results[f"meas2expert{i}_length_aorta"] = abs(diameter_ao - gt_len_ao)
-                    if ao_model_pts[0] and ao_model_pts[1]:
-                        pt_err_ao = pointwise_distance_error(experts_data[f"expert{i}_red"], ao_model_pts)
-                        results[f"meas2expert{i}_point_aorta"] = pt_err_ao
-
-            results.update(calculate_expert_errors(experts_data))
-            all_errors[image_name] = results
-
-        except Exception as e:
-            print(f"[{model_name}] Error processing {image_name}: {e}")
-
-    save_path = os.path.join(output_dir, f"deviation_3VV_from_csv_{model_name}.json")
-    save_json(all_errors, save_path)
+    image_names, table, lengths = evaluate_measurements(meas_data, gold)
+
+    save_path = deviation_path(output_dir, model_name)
+    save_deviation_table(save_path, image_names, table, lengths)
     print(f"[{model_name}] results saved in {save_path}")
+    if write_json:
+        json_path = deviation_path(output_dir, model_name, ".json")
+        save_json(error_records(image_names, table), json_path)
+        print(f"[{model_name}] JSON export saved in {json_path}")
+    return len(image_names)
 
-def main():
-    groups = {
-        "group1": load_json(os.path.join(GROUPS_PATH, "group1.json")),
-        "group2": load_json(os.path.join(GROUPS_PATH, "group2.json")),
-        "group3": load_json(os.path.join(GROUPS_PATH, "group3.json")),
-    }
-    for model_name, meas_path in MODEL_FILES.items():
-        process_one_model(meas_path, model_name, groups, OUTPUT_DIR)
+_worker_gold = None
+
+def _init_worker(gold):
+    # Under fork the gold standard is inherited copy-on-write; under spawn it is
+    # unpickled once per worker rather than once per model.
+    global _worker_gold
+    _worker_gold = gold
+
+def _evaluate_model(model_name, meas_path, output_dir, write_json):
+    start = time.perf_counter()
+    n_images = process_one_model(meas_path, model_name, _worker_gold, output_dir, write_json)
+    return model_name, n_images, time.perf_counter() - start
+
+def process_models(model_files, gold, output_dir, workers=None, write_json=None):
+    """
+    Evaluates every model against the same parsed gold standard, across ``workers``
+    processes when there is more than one model. A model that fails is reported and
+    left out of the returned {model: (images, seconds)}.
+    """
+    workers = setting('WORKERS') if workers is None else workers
+    write_json = setting('DEVIATION_JSON') if write_json is None else write_json
+    timings = {}
+    if workers <= 1 or len(model_files) <= 1:
+        _init_worker(gold)
+        for model_name, meas_path in model_files.items():
+            try:
+                model_name, n_images, elapsed = _evaluate_model(model_name, meas_path, output_dir, write_json)
+            except Exception as e:
+                print(f"[{model_name}] Error evaluating model: {e}")
+                continue
+            timings[model_name] = (n_images, elapsed)
+            print(f"[{model_name}] {n_images} images evaluated in {elapsed:.2f}s ({len(timings)}/{len(model_files)})")
+        return timings
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(model_files)),
+                             initializer=_init_worker, initargs=(gold,)) as pool:
+        futures = {pool.submit(_evaluate_model, model_name, meas_path, output_dir, write_json): model_name
+                   for model_name, meas_path in model_files.items()}
+        for future in as_completed(futures):
+            try:
+                model_name, n_images, elapsed = future.result()
+            except Exception as e:
+                print(f"[{futures[future]}] Error evaluating model: {e}")
+                continue
+            timings[model_name] = (n_images, elapsed)
+            print(f"[{model_name}] {n_images} images evaluated in {elapsed:.2f}s ({len(timings)}/{len(model_files)})")
+    return {model_name: timings[model_name] for model_name in model_files if model_name in timings}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare measured AO/PA diameters against the expert annotations.")
+    parser.add_argument("--workers", type=int, default=setting('WORKERS'),
+                        help="number of models evaluated in parallel (default: 'workers' in config.yaml)")
+    parser.add_argument("--json", dest="write_json", action="store_true", default=setting('DEVIATION_JSON'),
+                        help="also export each model's deviations as indented JSON (default: 'deviation_json' in config.yaml)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    gold = GoldStandard(load_gold_standard())
+    process_models(setting('MODEL_FILES'), gold, setting('OUTPUT_DIR'), workers=args.workers,
+                   write_json=args.write_json)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,45 +1,457 @@
 import json
 import os
-from collections import defaultdict
-import yaml
+import math
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 
-with open("config.yaml", "r", encoding="utf-8") as f:
-    cfg = yaml.safe_load(f)
+try:
+    from .config import settings_accessors
+    from .evaluate import load_deviation_table
+except ImportError:  # run as a script from src/
+    from config import settings_accessors
+    from evaluate import load_deviation_table
 
-BASE_PATH = cfg["output_dir"]
-MODEL_NAMES = ["unet", "unetpp", "wnet"]
+_SETTINGS = {
+    'BASE_PATH': lambda cfg: cfg["output_dir"],
+    'MODEL_NAMES': lambda cfg: list(cfg.get("model_files") or {}),
+    # Errors above this many pixels are treated as failed measurements and left out; null keeps everything.
+    'OUTLIER_THRESHOLD': lambda cfg: cfg.get("outlier_threshold", 1000),
+    'WORKERS': lambda cfg: cfg.get("workers", 1),
+    'BOOTSTRAP_SAMPLES': lambda cfg: cfg.get("bootstrap_samples", 2000),
+    'BOOTSTRAP_SEED': lambda cfg: cfg.get("bootstrap_seed", 0),
+}
+setting, __getattr__ = settings_accessors(__name__, _SETTINGS)
+
+# Default for arguments that take their value from config.yaml (None is a meaningful outlier_threshold)
+FROM_CONFIG = object()
+
+def _configured(value, name):
+    return setting(name) if value is FROM_CONFIG else value
+
+CONFIDENCE = 0.95
+# Upper bound on the (replicates x images) weight matrix built per bootstrap chunk
+_BOOTSTRAP_CHUNK_ELEMENTS = 1 << 23
+
+# Percentiles come from a log-bucketed histogram (as in DDSketch): every estimate is
+# within SKETCH_ACCURACY relative error, memory is fixed per metric and two histograms
+# merge by addition.
+SKETCH_ACCURACY = 0.01
+SKETCH_MIN = 1e-6
+SKETCH_BINS = 1600
+_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
 
 def load_json(path):
     with open(path, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def calculate_global_averages(data):
-    sums = defaultdict(float)
-    counts = defaultdict(int)
-    for image_name, image_metrics in data.items():
+def _sketch_bins(values):
+    # Bin 0 holds (near-)zero errors; bin k >= 1 holds (SKETCH_MIN * gamma^(k-1), SKETCH_MIN * gamma^k].
+    bins = np.zeros(values.shape, dtype=np.intp)
+    positive = values > SKETCH_MIN
+    bins[positive] = np.ceil(np.log(values[positive] / SKETCH_MIN) / _LOG_GAMMA)
+    return np.minimum(bins, SKETCH_BINS - 1)
+
+class MetricStats:
+    """
+    One-pass statistics for a fixed list of metrics: count, mean and variance
+    (Welford, combined batch-wise), min/max and approximate percentiles. Fed with
+    (rows, metrics) batches where NaN marks a missing value; instances for disjoint
+    data can be merged.
+    """
+
+    def __init__(self, metrics, outlier_threshold=FROM_CONFIG):
+        self.metrics = list(metrics)
+        self.outlier_threshold = _configured(outlier_threshold, 'OUTLIER_THRESHOLD')
+        m = len(self.metrics)
+        self.count = np.zeros(m, dtype=np.int64)
+        self.mean = np.zeros(m)
+        self.m2 = np.zeros(m)
+        self.min = np.full(m, np.inf)
+        self.max = np.full(m, -np.inf)
+        self.histogram = np.zeros((m, SKETCH_BINS), dtype=np.int64)
+
+    def update(self, batch):
+        batch = np.asarray(batch, dtype=np.float64).reshape(-1, len(self.metrics))
+        kept = ~np.isnan(batch)
+        if self.outlier_threshold is not None:
+            kept &= batch <= self.outlier_threshold
+        count = kept.sum(axis=0)
+        if not count.any():
+            return self
+        values = np.where(kept, batch, 0.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = values.sum(axis=0) / count
+            m2 = (np.where(kept, batch - mean, 0.0) ** 2).sum(axis=0)
+        self._combine(count, np.nan_to_num(mean), m2,
+                      np.where(kept, batch, np.inf).min(axis=0), np.where(kept, batch, -np.inf).max(axis=0))
+
+        columns = np.broadcast_to(np.arange(len(self.metrics)), batch.shape)[kept]
+        np.add.at(self.histogram, (columns, _sketch_bins(batch[kept])), 1)
+        return self
+
+    def _combine(self, count, mean, m2, lo, hi):
+        total = self.count + count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = mean - self.mean
+            self.mean = np.where(total > 0, self.mean + delta * count / total, 0.0)
+            self.m2 = np.where(total > 0, self.m2 + m2 + delta ** 2 * self.count * count / total, 0.0)
+        self.count = total
+        self.min = np.minimum(self.min, lo)
+        self.max = np.maximum(self.max, hi)
+
+    def with_metrics(self, metrics):
+        """The same statistics over a longer metric list (this list as its prefix), empty for the new metrics."""
+        wide = MetricStats(metrics, self.outlier_threshold)
+        m = len(self.metrics)
+        wide.count[:m], wide.mean[:m], wide.m2[:m] = self.count, self.mean, self.m2
+        wide.min[:m], wide.max[:m], wide.histogram[:m] = self.min, self.max, self.histogram
+        return wide
+
+    def merge(self, other):
+        if other.metrics != self.metrics:
+            raise ValueError("Cannot merge statistics over different metrics")
+        self._combine(other.count, other.mean, other.m2, other.min, other.max)
+        self.histogram += other.histogram
+        return self
+
+    def quantile(self, q):
+        """
+        Approximate q-quantile per metric (NaN for metrics without values), interpolated
+        linearly between the values at the floor and ceil of rank q * (count - 1) like
+        np.quantile; each of those two values is within SKETCH_ACCURACY of the true one.
+        """
+        result = np.full(len(self.metrics), np.nan)
+        cumulative = np.cumsum(self.histogram, axis=1)
+        for j in np.flatnonzero(self.count):
+            rank = q * (self.count[j] - 1)
+            low, high = math.floor(rank), math.ceil(rank)
+            k_low, k_high = np.searchsorted(cumulative[j], [low, high], side='right')
+            below, above = self._bucket_value(j, k_low), self._bucket_value(j, k_high)
+            result[j] = below + (rank - low) * (above - below)
+        return result
+
+    def _bucket_value(self, j, k):
+        estimate = 0.0 if k == 0 else SKETCH_MIN * _GAMMA ** int(k) * 2 / (_GAMMA + 1)
+        return min(max(estimate, self.min[j]), self.max[j])
+
+    def averages(self):
+        return {key: float(self.mean[j]) for j, key in enumerate(self.metrics) if self.count[j] > 0}
+
+    def summary(self):
+        median, p95 = self.quantile(0.5), self.quantile(0.95)
+        summary = {}
+        for j, key in enumerate(self.metrics):
+            n = int(self.count[j])
+            if n == 0:
+                continue
+            variance = float(self.m2[j] / (n - 1)) if n > 1 else 0.0
+            summary[key] = {
+                'count': n,
+                'mean': float(self.mean[j]),
+                'std': math.sqrt(variance),
+                'variance': variance,
+                'min': float(self.min[j]),
+                'max': float(self.max[j]),
+                'median': float(median[j]),
+                'p95': float(p95[j]),
+            }
+        return summary
+
+def iter_record_batches(data, batch_size=4096):
+    """
+    Streams {image: {metric: value}} deviation records as (metrics, batch) pairs;
+    the metric list grows as new metrics appear, in first-seen order.
+    """
+    metrics, columns, rows = [], {}, []
+    for image_metrics in data.values():
+        for key in image_metrics:
+            if key not in columns:
+                columns[key] = len(metrics)
+                metrics.append(key)
+        rows.append(image_metrics)
+        if len(rows) == batch_size:
+            yield metrics, _records_to_batch(rows, columns)
+            rows = []
+    if rows:
+        yield metrics, _records_to_batch(rows, columns)
+
+def _records_to_batch(rows, columns):
+    batch = np.full((len(rows), len(columns)), np.nan)
+    for i, image_metrics in enumerate(rows):
         for key, value in image_metrics.items():
-            if value > 1000:
+            batch[i, columns[key]] = value
+    return batch
+
+def stats_from_records(data, outlier_threshold=FROM_CONFIG):
+    stats = MetricStats([], outlier_threshold)
+    for metrics, batch in iter_record_batches(data):
+        if len(metrics) != len(stats.metrics):
+            stats = stats.with_metrics(metrics)
+        stats.update(batch)
+    return stats
+
+def stats_from_table(metrics, table, outlier_threshold=FROM_CONFIG, batch_size=65536):
+    stats = MetricStats(metrics, outlier_threshold)
+    for start in range(0, len(table), batch_size):
+        stats.update(table[start:start + batch_size])
+    return stats
+
+def calculate_global_averages(data, outlier_threshold=FROM_CONFIG):
+    return stats_from_records(data, outlier_threshold).averages()
+
+def records_to_table(data):
+    """(images, metrics, table) from {image: {metric: value}} records, NaN where a metric is missing."""
+    metrics, batches = [], []
+    for metrics, batch in iter_record_batches(data):
+        batches.append(batch)
+    table = np.full((len(data), len(metrics)), np.nan)
+    row = 0
+    for batch in batches:
+        table[row:row + len(batch), :batch.shape[1]] = batch
+        row += len(batch)
+    return list(data), list(metrics), table
+
+def load_model_table(model, base_path=FROM_CONFIG):
+    input_file = os.path.join(_configured(base_path, 'BASE_PATH'), f"deviation_3VV_from_csv_{model}.npz")
+    if os.path.exists(input_file):
+        return load_deviation_table(input_file)
+    # Deviations exported as JSON by an older evaluate.py
+    return records_to_table(load_json(os.path.splitext(input_file)[0] + ".json"))
+
+def drop_outliers(table, outlier_threshold=FROM_CONFIG):
+    outlier_threshold = _configured(outlier_threshold, 'OUTLIER_THRESHOLD')
+    table = np.array(table, dtype=np.float64)
+    if outlier_threshold is not None:
+        table[table > outlier_threshold] = np.nan
+    return table
+
+_bootstrap_values = None
+_bootstrap_kept = None
+
+def _init_bootstrap(values, kept):
+    global _bootstrap_values, _bootstrap_kept
+    _bootstrap_values, _bootstrap_kept = values, kept
+
+def _bootstrap_chunk(seed, n_samples):
+    # Each replicate's resampled image indices become a row of counts, so the resampled
+    # sums of every metric come out of one matrix product.
+    n = len(_bootstrap_values)
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, n, size=(n_samples, n)) + (np.arange(n_samples) * n)[:, None]
+    weights = np.bincount(picks.ravel(), minlength=n_samples * n).reshape(n_samples, n).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (weights @ _bootstrap_values) / (weights @ _bootstrap_kept)
+
+def bootstrap_means(table, n_samples=FROM_CONFIG, seed=FROM_CONFIG, workers=FROM_CONFIG):
+    """
+    (n_samples, metrics) bootstrap replicates of each column's mean, resampling images
+    (rows) with replacement; NaN entries are left out of the means. Replicates are drawn
+    in fixed chunks with seeds spawned from ``seed``, so the result does not depend on
+    ``workers``.
+    """
+    n_samples = _configured(n_samples, 'BOOTSTRAP_SAMPLES')
+    seed = _configured(seed, 'BOOTSTRAP_SEED')
+    workers = _configured(workers, 'WORKERS')
+    table = np.asarray(table, dtype=np.float64)
+    kept = ~np.isnan(table)
+    values = np.where(kept, table, 0.0)
+    if len(table) == 0:
+        return np.full((n_samples, table.shape[1]), np.nan)
+
+    chunk = max(1, min(n_samples, _BOOTSTRAP_CHUNK_ELEMENTS // len(table)))
+    sizes = [min(chunk, n_samples - start) for start in range(0, n_samples, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if workers > 1 and len(sizes) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(sizes)), initializer=_init_bootstrap,
+                                 initargs=(values, kept.astype(np.float64))) as pool:
+            replicates = list(pool.map(_bootstrap_chunk, seeds, sizes))
+    else:
+        _init_bootstrap(values, kept.astype(np.float64))
+        replicates = [_bootstrap_chunk(chunk_seed, size) for chunk_seed, size in zip(seeds, sizes)]
+    return np.concatenate(replicates)
+
+def _confidence_intervals(metrics, table, **kwargs):
+    replicates = bootstrap_means(table, **kwargs)
+    alpha = (1 - CONFIDENCE) / 2
+    # sum / count rather than np.nanmean, which warns about all-NaN columns
+    kept = ~np.isnan(table)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(kept, table, 0.0).sum(axis=0) / kept.sum(axis=0)
+    intervals = {}
+    for j, key in enumerate(metrics):
+        column = replicates[:, j][~np.isnan(replicates[:, j])]
+        if np.isnan(means[j]) or len(column) == 0:
+            continue
+        low, high = np.quantile(column, [alpha, 1 - alpha])
+        intervals[key] = {'mean': float(means[j]), 'ci_low': float(low), 'ci_high': float(high)}
+    return intervals
+
+def bootstrap_confidence_intervals(metrics, table, outlier_threshold=FROM_CONFIG, **kwargs):
+    """Percentile bootstrap CI of the mean of every meas2expert* metric."""
+    columns = [j for j, key in enumerate(metrics) if key.startswith("meas2expert")]
+    table = drop_outliers(np.asarray(table)[:, columns], outlier_threshold)
+    return _confidence_intervals([metrics[j] for j in columns], table, **kwargs)
+
+def paired_difference_intervals(model_a, model_b, outlier_threshold=FROM_CONFIG, **kwargs):
+    """
+    Bootstrap CI of mean(model_a - model_b) for every meas2expert* metric both models
+    report, over the images where both have a value; each replicate resamples the
+    same images for the two models.
+    """
+    images_a, metrics_a, table_a = model_a
+    images_b, metrics_b, table_b = model_b
+    rows_b = {name: i for i, name in enumerate(images_b)}
+    common = [(i, rows_b[name]) for i, name in enumerate(images_a) if name in rows_b]
+    rows_a = np.array([i for i, _ in common], dtype=np.intp)
+    rows_b = np.array([j for _, j in common], dtype=np.intp)
+    columns_b = {key: j for j, key in enumerate(metrics_b)}
+    metrics = [key for key in metrics_a if key.startswith("meas2expert") and key in columns_b]
+
+    a = drop_outliers(np.asarray(table_a)[rows_a][:, [metrics_a.index(key) for key in metrics]], outlier_threshold)
+    b = drop_outliers(np.asarray(table_b)[rows_b][:, [columns_b[key] for key in metrics]], outlier_threshold)
+    return _confidence_intervals(metrics, a - b, **kwargs)
+
+def load_rater_lengths(model, base_path=FROM_CONFIG):
+    """(raters, vessels, lengths) stored next to the errors, or None for tables without them."""
+    input_file = os.path.join(_configured(base_path, 'BASE_PATH'), f"deviation_3VV_from_csv_{model}.npz")
+    if not os.path.exists(input_file):
+        return None
+    with np.load(input_file) as data:
+        if 'lengths' not in data.files:
+            return None
+        return data['raters'].tolist(), data['vessels'].tolist(), data['lengths'].astype(np.float64)
+
+def icc(ratings):
+    """
+    ICC(2,1) (two-way random effects, absolute agreement, single rater) for each group in
+    an (images, groups, raters) array, using only the images every rater measured.
+    Returns (icc, images used) per group.
+    """
+    ratings = np.asarray(ratings, dtype=np.float64)
+    complete = ~np.isnan(ratings).any(axis=2)                       # (n, g)
+    n = complete.sum(axis=0)
+    k = ratings.shape[2]
+    x = np.where(complete[..., None], ratings, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        grand = x.sum(axis=(0, 2)) / (n * k)
+        row_means = x.mean(axis=2)                                  # (n, g)
+        col_means = x.sum(axis=0) / n[:, None]                      # (g, k)
+        row_dev = np.where(complete, row_means - grand, 0.0)
+        msr = k * (row_dev ** 2).sum(axis=0) / (n - 1)
+        msc = n * ((col_means - grand[:, None]) ** 2).sum(axis=1) / (k - 1)
+        residual = np.where(complete[..., None], x - row_means[..., None] - col_means + grand[:, None], 0.0)
+        mse = (residual ** 2).sum(axis=(0, 2)) / ((n - 1) * (k - 1))
+        value = (msr - mse) / (msr + (k - 1) * mse + k * (msc - mse) / n)
+    return np.where(n > 1, value, np.nan), n
+
+def bland_altman(a, b):
+    """
+    Bland-Altman statistics of a - b for each column of two (images, groups) arrays, over
+    the images where both are present: (bias, sd of the differences, images used).
+    """
+    diff = np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)
+    paired = ~np.isnan(diff)
+    n = paired.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bias = np.where(paired, diff, 0.0).sum(axis=0) / n
+        sd = np.sqrt((np.where(paired, diff - bias, 0.0) ** 2).sum(axis=0) / (n - 1))
+    return bias, sd, n
+
+def agreement_statistics(raters, vessels, lengths):
+    """
+    Bland-Altman bias and 95% limits of agreement plus ICC(2,1) for the model against
+    each expert and for every pair of experts, and the ICC of all experts together;
+    every pair and vessel is computed in one vectorized pass over the images.
+    """
+    pairs = [(a, b) for a in range(len(raters)) for b in range(a + 1, len(raters))]
+    first = lengths[:, [a for a, _ in pairs]]                       # (n, pairs, vessels)
+    second = lengths[:, [b for _, b in pairs]]
+    # Explicit sizes: a model without images has no rows to infer the -1 axis from.
+    shape = (len(lengths), len(pairs) * len(vessels))
+    bias, sd, n = bland_altman(first.reshape(shape), second.reshape(shape))
+    pair_icc, _ = icc(np.stack([first, second], axis=-1).reshape(shape + (2,)))
+
+    results = {}
+    for p, (a, b) in enumerate(pairs):
+        per_vessel = {}
+        for v, vessel in enumerate(vessels):
+            j = p * len(vessels) + v
+            if n[j] == 0:
                 continue
-            sums[key] += value
-            counts[key] += 1
-    averages = {key: (sums[key] / counts[key]) if counts[key] > 0 else None for key in sums}
-    return averages
+            per_vessel[vessel] = {
+                'n': int(n[j]),
+                'bias': float(bias[j]),
+                'loa_low': float(bias[j] - 1.96 * sd[j]),
+                'loa_high': float(bias[j] + 1.96 * sd[j]),
+                'icc': float(pair_icc[j]),
+            }
+        results[f"{raters[a]}_vs_{raters[b]}"] = per_vessel
 
-def main():
-    for model in MODEL_NAMES:
-        input_file = os.path.join(BASE_PATH, f"deviation_3VV_from_csv_{model}.json")
-        output_file = os.path.join(BASE_PATH, f"deviation_3VV_global_averages_1_{model}.json")
+    experts = [r for r, name in enumerate(raters) if name.startswith("expert")]
+    expert_icc, expert_n = icc(lengths[:, experts].transpose(0, 2, 1))
+    results["experts"] = {
+        vessel: {'n': int(expert_n[v]), 'icc': float(expert_icc[v])}
+        for v, vessel in enumerate(vessels) if expert_n[v] > 0
+    }
+    return results
 
-        print(f"\nProcessing model: {model}")
-        data = load_json(input_file)
-        avg_results = calculate_global_averages(data)
+def save_json(data, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+
+def write_model_summary(model, metrics, table, rater_lengths=None, base_path=FROM_CONFIG):
+    """
+    Writes one model's averages, statistics, bootstrap CIs and (when the diameters are
+    available) agreement statistics.
+    """
+    base_path = _configured(base_path, 'BASE_PATH')
+    output_file = os.path.join(base_path, f"deviation_3VV_global_averages_1_{model}.json")
+    stats_file = os.path.join(base_path, f"deviation_3VV_summary_{model}.json")
+    ci_file = os.path.join(base_path, f"deviation_3VV_bootstrap_{model}.json")
+    agreement_file = os.path.join(base_path, f"deviation_3VV_agreement_{model}.json")
+
+    stats = stats_from_table(metrics, table)
+    avg_results = stats.averages()
+    summary = stats.summary()
 
-        for key, val in sorted(avg_results.items()):
-            print(f"{key}: {val:.4f}")
+    for key in sorted(summary):
+        s = summary[key]
+        print(f"{key}: {s['mean']:.4f} (std {s['std']:.4f}, median {s['median']:.4f}, p95 {s['p95']:.4f})")
 
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(avg_results, f, indent=4, ensure_ascii=False)
-        print(f"Averages saved to: {output_file}")
+    save_json(avg_results, output_file)
+    save_json(summary, stats_file)
+    save_json(bootstrap_confidence_intervals(metrics, table), ci_file)
+    print(f"Averages saved to: {output_file}")
+    print(f"Statistics saved to: {stats_file}")
+    print(f"Bootstrap confidence intervals saved to: {ci_file}")
+
+    if rater_lengths is not None:
+        save_json(agreement_statistics(*rater_lengths), agreement_file)
+        print(f"Agreement statistics saved to: {agreement_file}")
+
+def write_model_differences(tables, base_path=FROM_CONFIG):
+    """Paired bootstrap CIs between every two models; ``tables`` maps model -> (images, metrics, table)."""
+    if len(tables) < 2:
+        return
+    base_path = _configured(base_path, 'BASE_PATH')
+    models = list(tables)
+    differences = {
+        f"{a} - {b}": paired_difference_intervals(tables[a], tables[b])
+        for i, a in enumerate(models) for b in models[i + 1:]
+    }
+    diff_file = os.path.join(base_path, "deviation_3VV_bootstrap_differences.json")
+    save_json(differences, diff_file)
+    print(f"\nPaired model differences saved to: {diff_file}")
+
+def main():
+    tables = {}
+    for model in setting('MODEL_NAMES'):
+        print(f"\nProcessing model: {model}")
+        tables[model] = load_model_table(model)
+        _, metrics, table = tables[model]
+        write_model_summary(model, metrics, table, load_rater_lengths(model))
+    write_model_differences(tables)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# With VESSELSEG_TIMING=1 in the environment (or after enable()) every timed stage adds to the in-process totals
+TIMING_ENV = "VESSELSEG_TIMING"
+
+_enabled = os.environ.get(TIMING_ENV, "") not in ("", "0")
+_local = threading.local()
+_totals = {}
+_totals_lock = threading.Lock()
+_NULL = nullcontext()
+
+def enable(on=True):
+    """Turns the totals on or off for this process and the worker processes it starts."""
+    global _enabled
+    _enabled = bool(on)
+    os.environ[TIMING_ENV] = "1" if _enabled else "0"
+
+def enabled():
+    return _enabled
+
+def _add(table, name, wall, cpu):
+    entry = table.get(name)
+    if entry is None:
+        table[name] = {'calls': 1, 'wall': wall, 'cpu': cpu}
+    else:
+        entry['calls'] += 1
+        entry['wall'] += wall
+        entry['cpu'] += cpu
+
+class _Stage:
+    __slots__ = ('name', 'records', 'wall', 'cpu')
+
+    def __init__(self, name, records):
+        self.name = name
+        self.records = records
+
+    def __enter__(self):
+        self.cpu = time.thread_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        if self.records is not None:
+            _add(self.records, self.name, wall, cpu)
+        with _totals_lock:
+            _add(_totals, self.name, wall, cpu)
+        return False
+
+def stage(name):
+    """
+    Times one stage, wall clock and this thread's CPU time in seconds:
+        with timing.stage("measure.rays"): ...
+    Returns a shared no-op context when timing is off and no record() is active.
+    """
+    records = getattr(_local, 'records', None)
+    if records is None and not _enabled:
+        return _NULL
+    return _Stage(name, records)
+
+@contextmanager
+def record():
+    """Collects this thread's stage timings, {stage: {'calls', 'wall', 'cpu'}}; they also go to the totals."""
+    previous = getattr(_local, 'records', None)
+    _local.records = records = {}
+    try:
+        yield records
+    finally:
+        _local.records = previous
+
+def merge(records):
+    """Adds stage timings recorded elsewhere (e.g. a worker process's record()) to the totals."""
+    with _totals_lock:
+        for name, entry in records.items():
+            total = _totals.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+            for key in ('calls', 'wall', 'cpu'):
+                total[key] += entry[key]
+
+def format_totals(records=None):
+    """The totals (or ``records``) as a table: calls, total and mean wall/CPU time per stage."""
+    records = totals() if records is None else records
+    lines = [f"{'stage':<12} {'calls':>8} {'wall s':>10} {'cpu s':>10} {'wall ms/call':>13}"]
+    for name, entry in records.items():
+        lines.append(f"{name:<12} {entry['calls']:>8} {entry['wall']:>10.3f} {entry['cpu']:>10.3f} "
+                     f"{1e3 * entry['wall'] / max(entry['calls'], 1):>13.3f}")
+    return "\n".join(lines)
+
+def totals():
+    """Per-stage totals since the process started or the last reset()."""
+    with _totals_lock:
+        return {name: dict(entry) for name, entry in _totals.items()}
+
+def reset():
+    with _totals_lock:
+        _totals.clear()